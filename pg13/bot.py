@@ -7,6 +7,7 @@ from discord import app_commands
 from discord.ext import commands
 
 from .config import token, prefix
+from .db import ScoresRepository, run_migrations
 
 logger = logging.getLogger(__name__)
 
@@ -62,7 +63,12 @@ class PG13Bot(commands.Bot):
         self.db_pool = await asyncpg.create_pool(database="pg-13",
                                                  user="pg-13")
 
+        # The schema has to be up to date before any cogs touch it
+        await run_migrations(self.db_pool)
+        self.scores_repository = ScoresRepository(self.db_pool)
+
         cog_list = [
+            "pg13.cogs.members",
             "pg13.cogs.scores",
             "pg13.cogs.dailies",
             "pg13.cogs.gamenights",
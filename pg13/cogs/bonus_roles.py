@@ -1,51 +1,203 @@
-import itertools
+import asyncio
 import logging
+import time
 
-from discord.ext import commands
+from discord.ext import commands, tasks
 
-from ..config import bonus_roles
+from .. import metrics
+from ..config import bonus_role_interval, guilds
 
 logger = logging.getLogger(__name__)
 
+# Number of top users in a guild who get its bonus role
+BONUS_ROLE_COUNT = 12
+
+# Maximum number of guilds to update bonus roles in at once on startup
+INIT_CONCURRENCY = 8
+
 
 class BonusRoles(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
 
+        # Guilds whose bonus roles may be out of date
+        self.dirty_guilds = set()
+        self.last_reconciled = {}
+
+        # userid -> score of each guild's current top users, as of the last
+        # update of its bonus roles
+        self.top_members = {}
+
+    async def cog_load(self):
+        self.reconcile_dirty_guilds.start()
+
+    async def cog_unload(self):
+        self.reconcile_dirty_guilds.cancel()
+
+    def mark_dirty(self, guild_id):
+        """Schedules a guild's bonus roles to be updated in the background."""
+        if guild_id in self.dirty_guilds:
+            metrics.increment("bonus_roles.coalesced")
+        else:
+            self.dirty_guilds.add(guild_id)
+
+    def score_changed(self, guild_id, userid, score):
+        """Marks a guild dirty if a score change could affect who's in its top.
+
+        Most changes can be ruled out from the cached top users alone.
+        """
+        if guild_id not in guilds:
+            return
+
+        if (top := self.top_members.get(guild_id)) is None:
+            return self.mark_dirty(guild_id)
+
+        if userid in top:
+            others = [(s, u) for u, s in top.items() if u != userid]
+
+            # Still ahead of someone else in the top, so the set is unchanged
+            if not others or (score, userid) > min(others):
+                top[userid] = score
+                metrics.increment("bonus_roles.skipped")
+                return
+
+        # Outside the top and below its cutoff
+        elif len(top) >= BONUS_ROLE_COUNT and (score, userid) < min(
+            (s, u) for u, s in top.items()):
+            metrics.increment("bonus_roles.skipped")
+            return
+
+        self.mark_dirty(guild_id)
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member):
+        # A returning member's score may put them back in the top
+        if member.guild.id not in guilds:
+            return
+
+        score = await self.bot.scores_repository.get_score(
+            member.guild.id, member.id)
+        if score is not None:
+            self.score_changed(member.guild.id, member.id, score)
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member):
+        # Someone else moves into the top
+        if member.id in self.top_members.get(member.guild.id, {}):
+            self.mark_dirty(member.guild.id)
+
+    @tasks.loop(seconds=1)
+    async def reconcile_dirty_guilds(self):
+        now = time.monotonic()
+
+        for guild_id in list(self.dirty_guilds):
+            # Guilds stay dirty until their interval is up
+            if now - self.last_reconciled.get(guild_id, 0) < bonus_role_interval:
+                continue
+
+            self.dirty_guilds.discard(guild_id)
+            self.last_reconciled[guild_id] = now
+
+            if (guild := self.bot.get_guild(guild_id)) is None:
+                continue
+
+            try:
+                await self.update_bonus_roles(guild)
+                metrics.increment("bonus_roles.reconciled")
+            except Exception:
+                logger.exception(
+                    f"Failed to update bonus roles in guild {guild.name}")
+
+    @reconcile_dirty_guilds.before_loop
+    async def wait_until_ready(self):
+        await self.bot.wait_until_ready()
+        await self.wait_for_members()
+
+    async def wait_for_members(self):
+        """Waits until guild_members is up to date.
+
+        Top users are found by joining against it, so a partly filled table
+        would make current bonus role holders lose the role.
+        """
+        if (members_cog := self.bot.get_cog("GuildMembers")) is not None:
+            await members_cog.members_reconciled.wait()
+
     @commands.Cog.listener()
     async def on_ready(self):
+        await self.wait_for_members()
         await self.init_bonus_roles()
 
     async def init_bonus_roles(self):
-        for guild in self.bot.guilds:
-            await self.update_bonus_roles(guild)
-
-        logger.info(f"Initialized all guild bonus roles")
-
-    async def update_bonus_roles(self, guild):
+        start = time.perf_counter()
+
+        bonus_guilds = [
+            guild for guild in self.bot.guilds
+            if self.get_bonus_role(guild) is not None
+        ]
+        top_rows = await self.bot.scores_repository.top_scores_many(
+            [guild.id for guild in bonus_guilds], BONUS_ROLE_COUNT)
+
+        # Role edits in different guilds don't share rate limits, so they can
+        # be done concurrently (up to a point)
+        semaphore = asyncio.Semaphore(INIT_CONCURRENCY)
+
+        async def init_guild(guild):
+            async with semaphore:
+                guild_start = time.perf_counter()
+                await self.apply_bonus_roles(guild, top_rows[guild.id])
+                logger.debug(
+                    f"Initialized bonus roles in guild {guild.name} in "
+                    f"{time.perf_counter() - guild_start:.2f}s")
+
+        results = await asyncio.gather(*map(init_guild, bonus_guilds),
+                                       return_exceptions=True)
+        for guild, result in zip(bonus_guilds, results):
+            if isinstance(result, Exception):
+                logger.error(
+                    f"Failed to initialize bonus roles in guild {guild.name}",
+                    exc_info=result,
+                )
+
+        logger.info(
+            f"Initialized bonus roles in {len(bonus_guilds)} guilds in "
+            f"{time.perf_counter() - start:.2f}s")
+
+    def get_bonus_role(self, guild):
         # Fetch guild's bonus role from config
-        if (bonus_id := bonus_roles.get(guild.id)) is None:
+        guild_config = guilds.get(guild.id)
+        if guild_config is None or (bonus_id :=
+                                    guild_config.bonus_role) is None:
             logger.debug(
                 f"Guild {guild.name} doesn't have a bonus role configured")
-            return
+            return None
 
         # Fetch role object to ensure it exists
         if (bonus_role := guild.get_role(bonus_id)) is None:
             logger.warn(
                 f"Guild {guild.name} doesn't have a role with the ID of {bonus_id}"
             )
+
+        return bonus_role
+
+    async def update_bonus_roles(self, guild):
+        if self.get_bonus_role(guild) is None:
             return
 
         # Fetch top users from guild
-        async with self.bot.db_pool.acquire() as con:
-            # TODO: Handle cases where someone in the top 12 left a server
-            top_12 = await con.fetch(
-                "SELECT userid FROM scores WHERE guild = $1 ORDER BY score DESC LIMIT 12",
-                guild.id,
-            )
-
-        top_users = set(map(lambda row: row["userid"], top_12))
+        top_rows = await self.bot.scores_repository.top_scores(
+            guild.id, BONUS_ROLE_COUNT)
+        await self.apply_bonus_roles(guild, top_rows)
+
+    async def apply_bonus_roles(self, guild, top_rows):
+        """Gives a guild's bonus role to exactly the users in `top_rows`."""
+        bonus_role = self.get_bonus_role(guild)
+        self.top_members[guild.id] = {
+            row["userid"]: row["score"]
+            for row in top_rows
+        }
+
+        top_users = set(self.top_members[guild.id])
         current_bonus_users = set(
             map(lambda member: member.id, bonus_role.members))
 
@@ -1,17 +1,38 @@
 import asyncio
+import collections
 import datetime
 import logging
-from zoneinfo import ZoneInfo
+import time
 
 import discord
 from discord import app_commands
 from discord.ext import commands, tasks
 
 from .checks import admin_check
-from ..config import daily_points, daily_max
+from .. import metrics
+from ..config import claim_batching, guilds
+from ..days import current_day
 
 logger = logging.getLogger(__name__)
 
+ChannelBonus = collections.namedtuple("ChannelBonus",
+                                      ["guild", "points", "attachment"])
+
+# A channel bonus claim waiting in the claim queue
+QueuedClaim = collections.namedtuple(
+    "QueuedClaim",
+    ["channel", "guild", "userid", "day", "points", "reason", "queued_at"],
+)
+
+DEFAULT_RESET = datetime.time(23, 58)
+
+
+def claim_day(guild_id):
+    """Returns the day daily rewards claimed now in a guild count towards."""
+    guild_config = guilds.get(guild_id)
+    return current_day(guild_config.daily_reset
+                       if guild_config is not None else DEFAULT_RESET)
+
 
 class DailyBonuses(
         commands.GroupCog,
@@ -23,27 +44,57 @@ class DailyBonuses(
         self.bot = bot
         self.db_pool = bot.db_pool
 
-    async def cog_load(self):
-        async with self.db_pool.acquire() as con:
-            # Channel bonuses
-            await con.execute(
-                "CREATE TABLE IF NOT EXISTS channel_bonuses"
-                "(channel BIGINT, guild BIGINT, points INT, attachment BOOLEAN, UNIQUE(channel, guild))"
-            )
+        # channel id -> ChannelBonus for every channel with a bonus attached,
+        # so messages in other channels don't have to touch the database
+        self.channel_bonuses = {}
 
-            # Channel bonus claims
-            await con.execute(
-                "CREATE TABLE IF NOT EXISTS channel_claims"
-                "(channel BIGINT, guild BIGINT, userid BIGINT, UNIQUE(channel, userid))"
-            )
+        # (channel, userid) -> day of each user's last claim of a channel's
+        # bonus; entries go stale at the guild's reset rather than being cleared
+        self.last_claims = {}
 
-            # `/daily claim` uses
-            await con.execute(
-                "CREATE TABLE IF NOT EXISTS daily_claims"
-                "(guild BIGINT, userid BIGINT, claimed BOOLEAN, streak_bonus INT, UNIQUE(guild, userid))"
-            )
+        # Claims are written in batches by a single worker when enabled; the
+        # queue being bounded makes message handlers wait when it falls behind
+        self.batch_claims = claim_batching.get("enabled", False)
+        self.claim_queue = asyncio.Queue(claim_batching.get("max_queue", 1000))
+        self.claim_interval = claim_batching.get("interval_ms", 5) / 1000
+        self.max_claim_batch = claim_batching.get("max_batch", 200)
+
+        # Claims the worker has taken off the queue but not started writing,
+        # and the write of its last batch, so unloading can finish both
+        self.claim_batch = []
+        self.claim_write = None
 
-        self.clear_daily_claims.start()
+    async def cog_load(self):
+        async with self.db_pool.acquire() as con:
+            bonus_rows = await con.fetch(
+                "SELECT channel, guild, points, attachment FROM channel_bonuses"
+            )
+            claim_rows = await con.fetch(
+                "SELECT channel, userid, claim_day FROM channel_claims")
+
+        self.channel_bonuses = {
+            row["channel"]: ChannelBonus(row["guild"], row["points"],
+                                         row["attachment"])
+            for row in bonus_rows
+        }
+        self.last_claims = {(row["channel"], row["userid"]): row["claim_day"]
+                            for row in claim_rows}
+
+        if self.batch_claims:
+            self.process_claims.start()
+
+    async def cog_unload(self):
+        # Batch writes are shielded, so this only stops the worker waiting
+        self.process_claims.cancel()
+        if self.claim_write is not None:
+            await self.claim_write
+
+        # Write whatever was taken or is still queued before shutting down
+        claims, self.claim_batch = self.claim_batch, []
+        while not self.claim_queue.empty():
+            claims.append(self.claim_queue.get_nowait())
+        if claims:
+            await self.write_claim_batch(claims)
 
     # DAILY BONUS COMMAND
     @app_commands.command(
@@ -51,16 +102,20 @@ class DailyBonuses(
         description="Claim a daily reward of some points.",
     )
     async def daily_claim(self, interaction: discord.Interaction):
+        guild_config = guilds[interaction.guild_id]
+
         async with self.db_pool.acquire() as con:
-            # add user if not exists; update streak info/claim status if not yet claimed today
-            # cap bonus based on max number of points for guild
+            # add user if not exists; update streak info/claim day if not yet claimed today
+            # the streak continues if the last claim was yesterday, capped based on max number of points for guild
             streak_bonus = await con.fetchval(
-                "INSERT INTO daily_claims VALUES($1, $2, true, 0) "
-                "ON CONFLICT(guild, userid) DO UPDATE SET claimed = true, streak_bonus = LEAST(daily_claims.streak_bonus + 1, $3::INT) "
-                "WHERE NOT daily_claims.claimed "
+                "INSERT INTO daily_claims (guild, userid, streak_bonus, claim_day) VALUES($1, $2, 0, $4) "
+                "ON CONFLICT(guild, userid) DO UPDATE SET claim_day = EXCLUDED.claim_day, streak_bonus = "
+                "CASE WHEN daily_claims.claim_day = EXCLUDED.claim_day - 1 THEN LEAST(daily_claims.streak_bonus + 1, $3::INT) ELSE 0 END "
+                "WHERE daily_claims.claim_day < EXCLUDED.claim_day "
                 "RETURNING streak_bonus", interaction.guild_id,
-                interaction.user.id, daily_max[interaction.guild_id] -
-                daily_points[interaction.guild_id])
+                interaction.user.id,
+                guild_config.daily_max - guild_config.daily_points,
+                claim_day(interaction.guild_id))
 
         if streak_bonus is None:
             logger.debug(
@@ -74,8 +129,9 @@ class DailyBonuses(
             if (scores_cog := self.bot.get_cog("Scores")) is not None:
                 await scores_cog.increment_score(
                     interaction.user,
-                    daily_points[interaction.guild_id] + streak_bonus,
+                    guild_config.daily_points + streak_bonus,
                     "Claimed daily reward",
+                    self.qualified_name,
                 )
 
             await interaction.response.send_message(
@@ -115,6 +171,8 @@ class DailyBonuses(
                 f"{channel.mention} already has a daily point reward!",
                 ephemeral=True)
         else:
+            self.channel_bonuses[channel.id] = ChannelBonus(
+                channel.guild.id, points, attachment)
             await interaction.response.send_message(
                 f"Successfully added {points}-point daily bonus to {channel.mention}!",
                 ephemeral=True,
@@ -139,6 +197,11 @@ class DailyBonuses(
                 interaction.guild_id,
             )
 
+        self.channel_bonuses.pop(channel.id, None)
+        self.last_claims = {(channel_id, userid): day
+                            for (channel_id, userid), day in self.last_claims.items()
+                            if channel_id != channel.id}
+
         deleted_bonuses = int(delete_result.split(" ")[-1])
         if deleted_bonuses == 0:
             await interaction.response.send_message(
@@ -195,17 +258,16 @@ class DailyBonuses(
     )
     @app_commands.check(admin_check)
     async def daily_clean_deleted(self, interaction: discord.Interaction):
-        async with self.db_pool.acquire() as con:
-            daily_channels = await con.fetch(
-                "SELECT channel FROM channel_bonuses WHERE guild = $1",
-                interaction.guild_id,
-            )
+        deleted_channels = [
+            channel_id for channel_id, bonus in self.channel_bonuses.items()
+            if bonus.guild == interaction.guild_id
+            and interaction.guild.get_channel(channel_id) is None
+        ]
 
-            deleted_channels = [
-                bonus["channel"] for bonus in daily_channels
-                if interaction.guild.get_channel(bonus["channel"]) is None
-            ]
+        for channel_id in deleted_channels:
+            del self.channel_bonuses[channel_id]
 
+        async with self.db_pool.acquire() as con:
             delete_result = await con.execute(
                 "DELETE FROM channel_bonuses WHERE channel = ANY($1::BIGINT[])",
                 deleted_channels,
@@ -229,51 +291,111 @@ class DailyBonuses(
         if message.author.bot:
             return
 
-        provided_attachment = bool(message.attachments or message.embeds)
+        # Most messages aren't in bonus channels
+        if (bonus := self.channel_bonuses.get(message.channel.id)) is None:
+            return
 
-        async with self.db_pool.acquire() as con:
-            bonus_points = await con.fetchval(
-                "WITH bonus_info AS (SELECT channel, guild, points, attachment FROM channel_bonuses WHERE channel = $1 AND guild = $2) "
-                # replicating implication of attachment -> provided
-                "INSERT INTO channel_claims (SELECT channel, guild, $3::BIGINT FROM bonus_info WHERE NOT attachment OR $4) "
-                "ON CONFLICT(channel, userid) DO NOTHING "
-                "RETURNING (SELECT points FROM bonus_info)",
-                message.channel.id,
-                message.guild.id,
-                message.author.id,
-                provided_attachment,
-            )
+        if bonus.attachment and not (message.attachments or message.embeds):
+            return
 
-            # give user extra point if they claimed all possible channel dailies in this guild
-            all_claimed = await con.fetchval(
-                "SELECT (SELECT count(*) FROM channel_bonuses WHERE guild = $1) = "
-                "(SELECT count(*) FROM channel_claims WHERE guild = $1 AND userid = $2)",
-                message.guild.id,
-                message.author.id,
-            )
+        if (scores_cog := self.bot.get_cog("Scores")) is None:
+            return
 
-        if (bonus_points is not None
-                and (scores_cog := self.bot.get_cog("Scores")) is not None):
-            await scores_cog.increment_score(
-                message.author,
-                bonus_points + int(all_claimed),
-                reason=f"Bonus claim in #{message.channel.name}",
-            )
+        # Repeat messages after claiming are the common case in bonus channels
+        # (the claim is remembered up front so concurrent messages don't
+        # claim twice, and forgotten again if it fails)
+        claim_key = (message.channel.id, message.author.id)
+        today = claim_day(message.guild.id)
+        if self.last_claims.get(claim_key) == today:
+            return
+        self.last_claims[claim_key] = today
 
-    @tasks.loop(time=datetime.time(23,
-                                   58,
-                                   tzinfo=ZoneInfo("America/Los_Angeles")))
-    async def clear_daily_claims(self):
-        async with self.db_pool.acquire() as con:
-            await con.execute("TRUNCATE TABLE channel_claims")
+        reason = f"Bonus claim in #{message.channel.name}"
+        if self.batch_claims:
+            if self.claim_queue.full():
+                metrics.increment("claims.backpressure")
 
-            # maintain streak (bonus) if user claimed bonus today, otherwise reset
-            # -1 is used instead of 0 since it's incremented on the first claim (to 0)
-            await con.execute(
-                "UPDATE daily_claims set streak_bonus = CASE WHEN claimed THEN streak_bonus ELSE -1 END, claimed = false"
+            await self.claim_queue.put(
+                QueuedClaim(message.channel.id, message.guild.id,
+                            message.author.id, today, bonus.points, reason,
+                            time.perf_counter()))
+            return
+
+        # claim, all-claimed bonus point & score update in one round trip
+        try:
+            claim = await self.bot.scores_repository.claim_channel_bonus(
+                message.channel.id,
+                message.guild.id,
+                message.author.id,
+                today,
+                bonus.points,
+                self.bot.event_multiplier,
+                reason=reason,
+                source=self.qualified_name,
             )
+        except Exception:
+            # Let the user claim again on their next message
+            self.last_claims.pop(claim_key, None)
+            raise
+
+        if claim is not None:
+            logger.debug(
+                f"Scores in guild {message.guild.id} updated (reason: {reason}): "
+                f"{message.author.id} -> {claim['awarded']} points")
+            scores_cog.scores_written([{
+                "guild": message.guild.id,
+                "userid": message.author.id,
+                "score": claim["new_score"],
+            }])
+
+    @tasks.loop()
+    async def process_claims(self):
+        # Wait for a claim, then give others a moment to join its batch
+        self.claim_batch = [await self.claim_queue.get()]
+        await asyncio.sleep(self.claim_interval)
+
+        while (len(self.claim_batch) < self.max_claim_batch
+               and not self.claim_queue.empty()):
+            self.claim_batch.append(self.claim_queue.get_nowait())
+
+        claims, self.claim_batch = self.claim_batch, []
+        self.claim_write = asyncio.ensure_future(self.write_claim_batch(claims))
+        await asyncio.shield(self.claim_write)
+
+    async def write_claim_batch(self, claims):
+        try:
+            await self.write_claims(claims)
+        except Exception:
+            logger.exception(f"Failed to write {len(claims)} channel claims")
+
+            # Let the users claim again on their next message
+            for claim in claims:
+                self.last_claims.pop((claim.channel, claim.userid), None)
+
+    async def write_claims(self, claims):
+        """Claims & awards a batch of queued channel bonuses in one statement."""
+        if not claims:
+            return
 
-        logger.debug("Cleared all daily reward tables")
+        new_scores = await self.bot.scores_repository.claim_channel_bonuses(
+            [(claim.channel, claim.guild, claim.userid, claim.day,
+              claim.points, claim.reason) for claim in claims],
+            self.bot.event_multiplier,
+            source=self.qualified_name,
+        )
+
+        written = time.perf_counter()
+        metrics.observe("claims.batch_size", len(claims))
+        for claim in claims:
+            metrics.observe("claims.latency_ms",
+                            (written - claim.queued_at) * 1000)
+
+        logger.debug(
+            f"Wrote {len(claims)} queued channel claims "
+            f"({len(new_scores)} users awarded)")
+
+        if (scores_cog := self.bot.get_cog("Scores")) is not None:
+            scores_cog.scores_written(new_scores)
 
 
 async def setup(bot):
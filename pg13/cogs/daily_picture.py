@@ -1,55 +1,105 @@
+import asyncio
+import collections
 import datetime
 import logging
 import pathlib
-import random
 from zoneinfo import ZoneInfo
 
-import discord
 from discord.ext import commands, tasks
 
-from ..config import picture_channels
+from .picture_catalog import PictureCatalog
+from ..config import guilds
+from ..uploads import upload_cache
 
 logger = logging.getLogger(__name__)
 
+# A picture picked (and read) ahead of the next send
+PreparedPicture = collections.namedtuple("PreparedPicture",
+                                         ["path", "data"])
+
 
 class DailyPicture(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
+        self.catalog = PictureCatalog("databases/pictures.db")
+
+        # (guild id, folder) -> PreparedPicture for the next send
+        self.prepared = {}
 
-    @commands.Cog.listener()
-    async def on_ready(self):
+    async def cog_load(self):
+        await self.catalog.open()
         self.send_pictures.start()
 
+    async def cog_unload(self):
+        self.send_pictures.cancel()
+        await self.catalog.close()
+
+    def picture_folders(self):
+        """Yields the (guild id, folder, channel id) of every picture folder."""
+        for guild_id, guild_config in guilds.items():
+            for folder, channel_id in guild_config.picture_channels.items():
+                yield guild_id, folder, channel_id
+
+    async def prepare_pictures(self):
+        """Rescans the picture folders and picks & reads the next pictures.
+
+        Done right after each send so the 10:00 send only has to upload.
+        """
+        self.prepared = {}
+
+        for guild_id, folder, _ in self.picture_folders():
+            picture_dir = pathlib.Path(f"dailyphotos/{guild_id}") / folder
+            if not picture_dir.is_dir():
+                logger.warn(
+                    f"Daily picture directory {folder} for guild {guild_id} does not exist; skipping"
+                )
+                continue
+
+            # One bad folder shouldn't keep the others from being prepared
+            try:
+                await self.prepare_folder(guild_id, folder, picture_dir)
+            except Exception:
+                logger.exception(
+                    f"Unable to prepare daily picture folder {folder} for guild {guild_id}"
+                )
+
+    async def prepare_folder(self, guild_id, folder, picture_dir):
+        await self.catalog.rescan(guild_id, folder, picture_dir)
+        if (path := await self.catalog.next_picture(guild_id,
+                                                    folder)) is None:
+            return
+
+        data = await asyncio.to_thread(pathlib.Path(path).read_bytes)
+        self.prepared[(guild_id, folder)] = PreparedPicture(path, data)
+
     @tasks.loop(time=datetime.time(10, 00, tzinfo=ZoneInfo("America/Los_Angeles")))
     async def send_pictures(self):
-        for guild_id, channel_dict in picture_channels.items():
+        for guild_id, folder, channel_id in self.picture_folders():
             if (guild := self.bot.get_guild(guild_id)) is None:
                 logger.warn(f"Unable to fetch guild {guild_id}")
 
-            else:
-                picture_base_dir = pathlib.Path(f"dailyphotos/{guild_id}")
-
-                for folder, channel_id in channel_dict.items():
-                    if (picture_channel :=
-                            guild.get_channel(channel_id)) is None:
-                        logger.warn(
-                            f"Guild {guild.name} has no channel with id {channel_id}"
-                        )
-                    else:
-                        picture_dir = picture_base_dir / folder
-                        if not picture_dir.is_dir():
-                            logger.warn(
-                                f"Daily picture directory {folder} for guild {guild_id} does not exist; skipping"
-                            )
-                        else:
-                            # recursively glob for (picture) files (i.e. not directories)
-                            pictures = list(picture_dir.rglob("*.*"))
-                            random_picture = random.choice(pictures)
-
-                            with open(random_picture, "rb") as picture:
-                                await picture_channel.send(file=discord.File(
-                                    picture, filename=random_picture.name))
+            elif (picture_channel := guild.get_channel(channel_id)) is None:
+                logger.warn(
+                    f"Guild {guild.name} has no channel with id {channel_id}")
+
+            elif (picture := self.prepared.get((guild_id, folder))) is not None:
+                try:
+                    await upload_cache.send_file(picture_channel.send,
+                                                 picture.data,
+                                                 pathlib.Path(picture.path).name)
+                    await self.catalog.mark_shown(picture.path)
+                except Exception:
+                    logger.exception(
+                        f"Unable to send daily picture {picture.path} in guild {guild.name}"
+                    )
+
+        await self.prepare_pictures()
+
+    @send_pictures.before_loop
+    async def wait_until_ready(self):
+        await self.bot.wait_until_ready()
+        await self.prepare_pictures()
 
 
 async def setup(bot):
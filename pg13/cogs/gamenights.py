@@ -2,37 +2,28 @@ import collections
 import datetime
 import functools
 import logging
-from zoneinfo import ZoneInfo
+import time
 
 import discord
 from discord import app_commands
 from discord.ext import commands, tasks
 
-from ..config import thresholds
+from ..config import guilds
+from ..days import current_day
 
 logger = logging.getLogger(__name__)
 
+# Voice time counts towards game nights from the most recent reset at this
+# time, or since a game night started if it's still going
+VOICE_LOG_RESET = datetime.time(11, 59)
+
 Participant = collections.namedtuple("Participant",
                                      ["member", "minutes", "formatted"])
 
 
 def gamenight_increment(guild, host_id, participant):
-    point_thresholds = thresholds[guild.id]
-
-    # Convert keys to ints (TOML makes them strings by default)
-    point_thresholds = {
-        int(minutes): bonus
-        for minutes, bonus in point_thresholds.items()
-    }
-
-    point_duration = max(
-        filter(
-            lambda threshold: threshold <= participant.minutes,
-            point_thresholds,
-        ),
-        default=0,
-    )
-    participation_points = point_thresholds.get(point_duration)
+    participation_points = guilds[guild.id].gamenight_points(
+        participant.minutes)
 
     if participation_points is not None:
         points = participation_points + (17 if participant.member.id == host_id
@@ -54,6 +45,24 @@ def leaderboard_entry(base_str, member_info, guild, host_id):
     )
 
 
+class VoiceSession:
+    """A user's accumulated time in a voice channel since the last reset."""
+
+    __slots__ = ("duration", "joined_at", "day")
+
+    def __init__(self, duration=0, day=None):
+        self.duration = duration
+        self.joined_at = None
+        self.day = day
+
+    def elapsed(self, now):
+        """Returns the seconds spent in the channel as of `now`."""
+        if self.joined_at is None:
+            return self.duration
+
+        return self.duration + now - self.joined_at
+
+
 class GameNights(
         commands.GroupCog,
         group_name="gamenight",
@@ -65,22 +74,68 @@ class GameNights(
         self.bot = bot
         self.db_pool = bot.db_pool
 
+        # channel id -> userid -> VoiceSession, timed with time.monotonic();
+        # only sessions in game night channels are ever written to voice_logs
+        self.sessions = collections.defaultdict(dict)
+
+        # voice channel id -> day each ongoing game night started on
+        self.gamenight_channels = {}
+
     async def cog_load(self):
         async with self.db_pool.acquire() as con:
-            # Ongoing gamenights
-            await con.execute(
-                "CREATE TABLE IF NOT EXISTS gamenights"
-                "(voice_channel BIGINT UNIQUE, guild BIGINT, host BIGINT, "
-                "start_channel BIGINT, UNIQUE(guild, host))")
+            gamenight_rows = await con.fetch(
+                "SELECT voice_channel, started_on FROM gamenights")
 
-            # Voice channel duration tracking
-            await con.execute(
-                "CREATE TABLE IF NOT EXISTS voice_logs"
-                "(channel BIGINT, guild BIGINT, userid BIGINT, "
-                "duration INTERVAL, join_time TIMESTAMP WITH TIME ZONE, "
-                "UNIQUE(channel, userid))")
+            # Pick up where ongoing game nights' last checkpoint left off
+            log_rows = await con.fetch(
+                "SELECT channel, userid, EXTRACT(EPOCH FROM duration) AS seconds, log_day "
+                "FROM voice_logs WHERE channel IN (SELECT voice_channel FROM gamenights)"
+            )
+
+        self.gamenight_channels = {
+            row["voice_channel"]: row["started_on"]
+            for row in gamenight_rows
+        }
+        for row in log_rows:
+            self.sessions[row["channel"]][row["userid"]] = VoiceSession(
+                float(row["seconds"]), row["log_day"])
+
+        self.checkpoint_sessions.start()
+
+    async def cog_unload(self):
+        self.checkpoint_sessions.cancel()
+        await self.write_checkpoint()
 
-        self.clear_voice_logs.start()
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # Sessions of users already in voice channels (e.g. after a restart)
+        now = time.monotonic()
+        for guild in self.bot.guilds:
+            for channel in guild.voice_channels + guild.stage_channels:
+                for member in channel.members:
+                    session = self.sessions[channel.id].get(member.id)
+                    if session is None or session.joined_at is None:
+                        self.join_channel(channel, member, now)
+
+    def join_channel(self, channel, member, now):
+        today = current_day(VOICE_LOG_RESET)
+        session = self.sessions[channel.id].setdefault(member.id,
+                                                       VoiceSession(day=today))
+
+        # Durations from before the last reset are dropped, unless they're
+        # part of a game night that's still going
+        if session.day < self.gamenight_channels.get(channel.id, today):
+            session.duration = 0
+
+        session.day = today
+        session.joined_at = now
+
+    def leave_channel(self, channel, member, now):
+        if (session := self.sessions[channel.id].get(member.id)) is None:
+            return
+
+        session.duration = session.elapsed(now)
+        session.joined_at = None
 
     @commands.Cog.listener()
     async def on_voice_state_update(self, member, before, after):
@@ -88,31 +143,67 @@ class GameNights(
         if before.channel == after.channel:
             return
 
-        # Check if user's current/previous voice channel had ongoing game night(s)
-        async with self.db_pool.acquire() as con:
-            if before.channel is not None:
-                # UPDATE is a noop if the WHERE clause doesn't match
-                left_gamenight = await con.fetchval(
-                    "WITH left_gamenight AS (SELECT TRUE FROM gamenights WHERE voice_channel = $2) "
-                    "UPDATE voice_logs SET duration = duration + (CURRENT_TIMESTAMP - join_time) WHERE userid = $1 and channel = $2 RETURNING (SELECT * FROM left_gamenight)",
-                    member.id,
-                    before.channel.id,
-                )
-
-            if after.channel is not None:
-                await con.execute(
-                    "INSERT INTO voice_logs VALUES($1, $2, $3, '0S'::INTERVAL, CURRENT_TIMESTAMP) "
-                    "ON CONFLICT(channel, userid) DO UPDATE SET join_time = EXCLUDED.join_time",
-                    after.channel.id,
-                    after.channel.guild.id,
-                    member.id,
-                )
-                left_gamenight = False
-
-        if left_gamenight and not before.channel.members:
+        now = time.monotonic()
+        if before.channel is not None:
+            self.leave_channel(before.channel, member, now)
+
+        if after.channel is not None:
+            self.join_channel(after.channel, member, now)
+
+        # End the game night once its channel empties out
+        if (before.channel is not None
+                and before.channel.id in self.gamenight_channels
+                and not before.channel.members):
             await self.end_gamenight(before.channel)
 
+    @tasks.loop(minutes=1)
+    async def checkpoint_sessions(self):
+        # An error would otherwise stop the loop (and all later checkpoints)
+        try:
+            await self.write_checkpoint()
+        except Exception:
+            logger.exception("Failed to checkpoint game night voice sessions")
+
+        self.prune_sessions()
+
+    async def write_checkpoint(self):
+        """Saves the sessions in game night channels for crash recovery."""
+        now = time.monotonic()
+        rows = [(channel_id, userid,
+                 datetime.timedelta(seconds=session.elapsed(now)), session.day)
+                for channel_id in self.gamenight_channels
+                for userid, session in self.sessions[channel_id].items()]
+
+        if not rows:
+            return
+
+        # join_time is when the row was last checkpointed
+        async with self.db_pool.acquire() as con:
+            await con.executemany(
+                "INSERT INTO voice_logs SELECT $1, guild, $2, $3, CURRENT_TIMESTAMP, $4 "
+                "FROM gamenights WHERE voice_channel = $1 "
+                "ON CONFLICT(channel, userid) DO UPDATE SET duration = EXCLUDED.duration, "
+                "join_time = EXCLUDED.join_time, log_day = EXCLUDED.log_day",
+                rows,
+            )
+
+    def prune_sessions(self):
+        # Stale sessions of users who left would be reset on rejoining anyway
+        today = current_day(VOICE_LOG_RESET)
+        for channel_id, channel_sessions in list(self.sessions.items()):
+            if channel_id in self.gamenight_channels:
+                continue
+
+            for userid, session in list(channel_sessions.items()):
+                if session.joined_at is None and session.day < today:
+                    del channel_sessions[userid]
+
+            if not channel_sessions:
+                del self.sessions[channel_id]
+
     async def end_gamenight(self, channel):
+        started_on = self.gamenight_channels.pop(channel.id, None)
+
         # in db:
         async with self.db_pool.acquire() as con:
             #  get game night info (error if ending nonexistent?)
@@ -122,16 +213,11 @@ class GameNights(
                 channel.guild.id,
             )
 
-            #  grab user/duration combos (only need/extract hour/minute)
-            participants = await con.fetch(
-                "SELECT userid, EXTRACT(EPOCH FROM duration)/60 AS minutes, to_char(duration, 'HH24:MI') AS formatted "
-                "FROM voice_logs WHERE channel = $1 ORDER BY duration DESC",
-                channel.id,
-            )
-
-            #  delete from voice_logs/gamenights (or just gamenights? logs cleared at midnight)
+            #  delete from gamenights/voice_logs (durations are kept in memory)
             await con.execute(
                 "DELETE FROM gamenights WHERE voice_channel = $1", channel.id)
+            await con.execute("DELETE FROM voice_logs WHERE channel = $1",
+                              channel.id)
 
         if gamenight_info is None:
             logger.warn(
@@ -141,11 +227,22 @@ class GameNights(
 
         host_id = gamenight_info["host"]
 
+        # grab user/duration combos from sessions since the game night started
+        now = time.monotonic()
+        durations = sorted(
+            ((userid, session.elapsed(now))
+             for userid, session in self.sessions[channel.id].items()
+             if started_on is None or session.day >= started_on),
+            key=lambda duration: duration[1],
+            reverse=True,
+        )
+
         # filter users who left & bots out of gamenight participants
         participants = [
-            Participant(member, row["minutes"], row["formatted"])
-            for row in participants
-            if (member := channel.guild.get_member(row["userid"])) is not None
+            Participant(member, seconds / 60,
+                        f"{int(seconds // 3600):02}:{int(seconds % 3600 // 60):02}")
+            for userid, seconds in durations
+            if (member := channel.guild.get_member(userid)) is not None
             and not member.bot
         ]
 
@@ -171,7 +268,10 @@ class GameNights(
                 if (bonus := guild_increment(participant)) is not None
             ]
             await scores_cog.bulk_increment_scores(
-                point_increments, reason="Gamenight participation points")
+                point_increments,
+                reason="Gamenight participation points",
+                source=self.qualified_name,
+            )
 
         summary_channel = channel.guild.get_channel(
             gamenight_info["start_channel"])
@@ -188,7 +288,7 @@ class GameNights(
     async def gamenight_host(self,
                              interaction: discord.Interaction,
                              host: discord.Member = None):
-        if interaction.guild_id not in thresholds:
+        if interaction.guild_id not in guilds:
             logger.warn(
                 f"Attempted to start game night in unconfigured guild {interaction.guild.name}"
             )
@@ -208,33 +308,28 @@ class GameNights(
             host = interaction.user
 
         gamenight_channel = voice_state.channel
+        started_on = current_day(VOICE_LOG_RESET)
 
         async with self.db_pool.acquire() as con:
             # Add host/voice channel to guild game night table
             await con.execute(
-                f"INSERT INTO gamenights VALUES($1, $2, $3, $4)",
+                f"INSERT INTO gamenights VALUES($1, $2, $3, $4, $5)",
                 gamenight_channel.id,
                 interaction.guild_id,
                 host.id,
                 interaction.channel_id,
+                started_on,
             )
 
+        # Voice sessions in the channel are persisted from now on
+        self.gamenight_channels[gamenight_channel.id] = started_on
+        await self.write_checkpoint()
+
         await interaction.response.send_message(
             f"Started game night in voice channel {gamenight_channel.name}!")
         logger.info(f"Started game night in channel {gamenight_channel.name} "
                     f"with {len(gamenight_channel.members)} initial members")
 
-    @tasks.loop(time=datetime.time(11,
-                                   59,
-                                   0,
-                                   tzinfo=ZoneInfo("America/Los_Angeles")))
-    async def clear_voice_logs(self):
-        async with self.db_pool.acquire() as con:
-            # Don't delete logs from channels with an ongoing gamenight
-            await con.execute(
-                "DELETE FROM voice_logs WHERE channel NOT IN (SELECT voice_channel FROM gamenights)"
-            )
-
 
 async def setup(bot):
     await bot.add_cog(GameNights(bot))
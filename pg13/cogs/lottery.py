@@ -1,15 +1,19 @@
 import asyncio
-from datetime import datetime, timedelta
+import collections
+import datetime
 import logging
 import random
-from zoneinfo import ZoneInfo
+import time
 
 import discord
 from discord import app_commands
 from discord.ext import commands, tasks
 
-from ..config import lottery_channels
+from .scores import Increment
+from .. import config
+from ..config import guilds
 from ..common import CogMissing
+from ..days import RESET_TIMEZONE, current_day
 
 logger = logging.getLogger(__name__)
 
@@ -17,13 +21,42 @@ MIN_POINTS = 75
 MEAN_INCREMENT = 25
 EXP_LAMBDA = 1 / MEAN_INCREMENT
 
+# Most tickets a user can hold for a single drawing
+MAX_TICKETS = 10
 
-def prize_rng():
+# Drawings happen at noon on Sundays
+DRAW_TIME = datetime.time(12, 0, tzinfo=RESET_TIMEZONE)
+
+# Maximum number of guilds to draw in at once
+DRAW_CONCURRENCY = 8
+
+
+def prize_rng(rng=random):
     """Generates a random lottery prize value.
     The minimum number of points is defined as MIN_POINTS, with the mean prize
     amount being 100 (I think).
     """
-    return int(MIN_POINTS + random.expovariate(EXP_LAMBDA))
+    return int(MIN_POINTS + rng.expovariate(EXP_LAMBDA))
+
+
+def lottery_channel(guild_id):
+    """Returns a guild's lottery announcement channel id, if it has one."""
+    if (guild_config := guilds.get(guild_id)) is not None:
+        return guild_config.lottery_channel
+
+    return None
+
+
+def upcoming_draw_week():
+    """Returns the date of the next drawing, which tickets bought now are for."""
+    # Days are counted from noon, so on a Sunday afternoon this is a Sunday
+    day = current_day(DRAW_TIME)
+    return day + datetime.timedelta(days=7 - day.isoweekday() % 7)
+
+
+def last_draw_week():
+    """Returns the date of the most recent drawing that should've happened."""
+    return upcoming_draw_week() - datetime.timedelta(days=7)
 
 
 class Lottery(commands.Cog):
@@ -35,184 +68,259 @@ class Lottery(commands.Cog):
         self.db_pool = bot.db_pool
 
     async def cog_load(self):
-        # table initialization
-        async with self.db_pool.acquire() as con:
-            await con.execute(
-                "CREATE TABLE IF NOT EXISTS lottery"
-                "(guild BIGINT, userid BIGINT, PRIMARY KEY(guild, userid))"
-            )
-
         self.lottery_draw.start()
 
-    @property
-    def next_draw_time(self):
-        """Fetches the next lottery draw time as a datetime.datetime object"""
-        # 1-second addition is a hack to make next draw time work properly
-        # this breaks if the bot starts up right at a draw time but that's extremely unlikely so ;)
-        nowish = datetime.now(
-            ZoneInfo("America/Los_Angeles")) + timedelta(seconds=1)
-        today_weekday = nowish.weekday()
-
-        # 6 -> Sunday, as represented by datetime.weekday()
-        days_until_draw = 6 - today_weekday
+    async def cog_unload(self):
+        self.lottery_draw.cancel()
 
-        # lottery drawings happen at noon on Sundays
-        draw_datetime = (nowish + timedelta(days=days_until_draw)).replace(
-            hour=12, minute=0, second=0)
+    def draw_rng(self, guild_id, draw_week):
+        """Returns the random number generator for one guild's drawing.
 
-        # used to check if the draw time already passed today
-        passed = False
+        If a seed is configured, each draw gets its own generator derived from
+        it, so results don't depend on the order concurrent draws run in.
+        """
+        if config.lottery_seed is None:
+            return random.Random()
 
-        # draw should have happened earlier the same day; do it now to not miss a week
-        if draw_datetime < nowish:
-            draw_datetime += timedelta(days=7)
-            passed = True
+        return random.Random(f"{config.lottery_seed}:{guild_id}:{draw_week}")
 
-        return draw_datetime, passed
+    @property
+    def next_draw_time(self):
+        """Fetches the next lottery draw time as a datetime.datetime object"""
+        return datetime.datetime.combine(upcoming_draw_week(), DRAW_TIME)
 
     @app_commands.command(
-        description="Buy a lottery ticket for 20 points. Drawings happen every Sunday for 75-250 points."
+        description="Buy lottery tickets for 20 points each. Drawings happen every Sunday for 75-250 points."
     )
-    async def buyticket(self, interaction: discord.Interaction):
+    @app_commands.describe(
+        count=f"Number of tickets to buy (at most {MAX_TICKETS} per drawing)")
+    async def buyticket(self,
+                        interaction: discord.Interaction,
+                        count: app_commands.Range[int, 1, MAX_TICKETS] = 1):
         # store ids for easy access
         guildid = interaction.guild_id
         userid = interaction.user.id
 
         # we need a configured announcement channel
-        if lottery_channels.get(guildid) is None:
+        if lottery_channel(guildid) is None:
             return await interaction.response.send_message(
                 "Tell an admin to configure lottery announcements properly :)",
                 ephemeral=True,
             )
 
-        async with self.db_pool.acquire() as con:
-            already_claimed = await con.fetchval(
-                "SELECT TRUE FROM lottery WHERE userid = $1 AND guild = $2",
-                userid, guildid)
-
-            if not already_claimed:
-                buy_res = await con.execute(
-                    """
-                    WITH member_info AS (UPDATE scores SET score = score - 20
-                        WHERE userid = $1 AND guild = $2 AND scores.score >= 20
-                        RETURNING guild, userid)
-                    INSERT INTO lottery (guild, userid) (SELECT * FROM member_info)
-                    """, userid, guildid)
-
-        next_draw_unix = int(self.next_draw_time[0].timestamp())
+        # buffered increments need to count towards the ticket price
+        await self.scores.flush_increments()
+
+        draw_week = upcoming_draw_week()
+
+        async with self.db_pool.acquire() as con, con.transaction():
+            # one purchase per user at a time, so concurrent purchases can't
+            # all pass the ticket limit check
+            await con.execute(
+                "SELECT pg_advisory_xact_lock(hashtextextended(format('lottery:%s:%s', $1::BIGINT, $2::BIGINT), 0))",
+                guildid, userid)
+
+            held_tickets = await con.fetchval(
+                "SELECT COALESCE(sum(tickets), 0) FROM lottery "
+                "WHERE guild = $1 AND draw_week = $2 AND userid = $3",
+                guildid, draw_week, userid)
+            too_many = held_tickets + count > MAX_TICKETS
+
+            if not too_many:
+                new_score = await self.bot.scores_repository.spend_points(
+                    guildid,
+                    userid,
+                    self.TICKET_COST * count,
+                    reason=f"Bought {count} lottery ticket(s)",
+                    source=self.qualified_name,
+                    con=con,
+                )
+
+                if new_score is not None:
+                    # number the tickets after those already sold
+                    first_ticket = await con.fetchval(
+                        "INSERT INTO lottery_pools (guild, draw_week, tickets) VALUES($1, $2, $3) "
+                        "ON CONFLICT(guild, draw_week) DO UPDATE SET tickets = lottery_pools.tickets + EXCLUDED.tickets "
+                        "RETURNING tickets - $3", guildid, draw_week, count)
+                    await con.execute(
+                        "INSERT INTO lottery (guild, userid, first_ticket, tickets, draw_week) "
+                        "VALUES($1, $2, $3, $4, $5)",
+                        guildid, userid, first_ticket, count, draw_week)
+
+        next_draw_unix = int(self.next_draw_time.timestamp())
         next_draw_timestamp = f"<t:{next_draw_unix}:F>"
 
-        if already_claimed:
-            next_draw_unix = int(self.next_draw_time[0].timestamp())
+        if too_many:
             await interaction.response.send_message(
-                "You already entered this week's lottery drawing! "
+                f"You already have {held_tickets} ticket(s) for this week's lottery drawing, "
+                f"and you can only hold {MAX_TICKETS}! "
                 f"Check back at {next_draw_timestamp} to see if you win :)",
                 ephemeral=True,
             )
         else:
-            # INSERT query result has form `INSERT oid count`, where count is the number of updated rows
-            updated_rows = int(buy_res.split()[-1])
-
-            if updated_rows == 1:
+            if new_score is not None:
                 await interaction.response.send_message(
-                    "You've been entered into this week's lottery drawing! "
+                    f"You've been entered into this week's lottery drawing with {held_tickets + count} ticket(s)! "
                     f"Check back at {next_draw_timestamp} to see if you won :)",
                     ephemeral=True)
             else:
                 await interaction.response.send_message(
-                    "You need at least 20 points to enter into the lottery :)",
+                    f"You need at least {self.TICKET_COST * count} points to buy {count} lottery ticket(s) :)",
                     ephemeral=True)
 
-    # do a lottery drawing every week at the same time
-    @tasks.loop(hours=24 * 7)
+    # lottery drawings happen at noon every Sunday; the loop checks daily so
+    # a draw missed while the bot was down is caught up on the next run
+    @tasks.loop(time=DRAW_TIME)
     async def lottery_draw(self):
-        logger.debug("Doing lottery drawing...")
-
-        # select random winners from each guild
-        winners = await self.db_pool.fetch("""
-            SELECT DISTINCT ON (guild) guild, userid
-                FROM lottery ORDER BY guild, random()
-            """)
-
-        next_draw_unix = int(self.next_draw_time[0].timestamp())
-        next_draw_timestamp = f"<t:{next_draw_unix}>"
-        winner_increments = []
-
-        for winner_record in winners:
-            # I don't think you can destructure records directly in a for loop (?)
-            guildid, userid = tuple(winner_record)
-
-            # NOTE: this assumes the bot is in the configured guild, as
-            # otherwise this throws an AttributeError (guild would be None)
-            guild = self.bot.get_guild(guildid)
-            win_member = guild.get_member(userid)
-
-            # TODO: refactor to avoid having to do repeated None checks :(
-            if win_member is not None:
-                # generate prize
-                prize = prize_rng()
-
-                # send out winner announcement
-                announcement_chan = guild.get_channel(
-                    lottery_channels[guildid])
-                if announcement_chan is not None:
-                    logger.debug(
-                        f"{win_member.name} just won lottery in guild {guild.name}")
-                    await announcement_chan.send(
-                        f"{win_member.mention} just won **{prize}** points in the lottery! "
-                        f"The next drawing will be at {next_draw_timestamp}, make sure to get your tickets by then!"
+        draw_day = datetime.datetime.now(RESET_TIMEZONE).weekday() == 6
+        await self.try_run_draws(catch_up=not draw_day)
+
+    @lottery_draw.before_loop
+    async def catch_up_draws(self):
+        await self.bot.wait_until_ready()
+        await self.try_run_draws(catch_up=True)
+
+    async def try_run_draws(self, catch_up):
+        # An error would otherwise stop (or never start) the loop for good;
+        # whatever wasn't drawn is caught up on the next run
+        try:
+            await self.run_draws(catch_up)
+        except Exception:
+            logger.exception("Failed to run lottery draws")
+
+    async def run_draws(self, catch_up):
+        """Draws last week's lottery in every guild that hasn't done it yet,
+        along with any earlier weeks whose tickets were never drawn (e.g. if
+        the bot was down for several drawings).
+
+        Draws are recorded in lottery_draws, so running this again (e.g.
+        after a restart) never draws a guild twice.
+        """
+        draw_week = last_draw_week()
+        lottery_guilds = [
+            guild for guild_id in guilds
+            if lottery_channel(guild_id) is not None
+            and (guild := self.bot.get_guild(guild_id)) is not None
+        ]
+
+        missed_weeks = collections.defaultdict(set)
+        async with self.db_pool.acquire() as con:
+            for row in await con.fetch(
+                    "SELECT DISTINCT guild, draw_week FROM lottery_pools AS pools "
+                    "WHERE draw_week < $1 AND NOT EXISTS (SELECT FROM lottery_draws AS draws "
+                    "WHERE draws.guild = pools.guild AND draws.draw_week = pools.draw_week)",
+                    draw_week):
+                missed_weeks[row["guild"]].add(row["draw_week"])
+
+        # Announcements in different guilds don't share rate limits
+        semaphore = asyncio.Semaphore(DRAW_CONCURRENCY)
+
+        async def draw(guild):
+            async with semaphore:
+                # oldest missed weeks first, each of them a catch-up
+                for missed_week in sorted(missed_weeks[guild.id]):
+                    await self.draw_guild(guild, missed_week, True)
+
+                await self.draw_guild(guild, draw_week, catch_up)
+
+        results = await asyncio.gather(*map(draw, lottery_guilds),
+                                       return_exceptions=True)
+        for guild, result in zip(lottery_guilds, results):
+            if isinstance(result, Exception):
+                logger.error(f"Lottery draw failed in guild {guild.name}",
+                             exc_info=result)
+
+    async def draw_guild(self, guild, draw_week, catch_up):
+        """Draws a guild's lottery for the week of `draw_week`.
+
+        The winning ticket is found by drawing a random ticket number and
+        seeking to the block of tickets containing it, so this doesn't have
+        to look at every ticket sold.
+        """
+        start = time.perf_counter()
+        rng = self.draw_rng(guild.id, draw_week)
+        win_member = prize = new_scores = None
+
+        async with self.db_pool.acquire() as con, con.transaction():
+            # Claims the draw; nothing is returned if it already happened
+            if not await con.fetchval(
+                    "INSERT INTO lottery_draws (guild, draw_week) VALUES($1, $2) "
+                    "ON CONFLICT DO NOTHING RETURNING TRUE", guild.id,
+                    draw_week):
+                return
+
+            tickets = await con.fetchval(
+                "SELECT tickets FROM lottery_pools WHERE guild = $1 AND draw_week = $2",
+                guild.id, draw_week)
+
+            if tickets:
+                userid = await con.fetchval(
+                    "SELECT userid FROM lottery WHERE guild = $1 AND draw_week = $2 "
+                    "AND first_ticket <= $3 ORDER BY first_ticket DESC LIMIT 1",
+                    guild.id, draw_week, rng.randrange(tickets))
+
+                if (win_member := guild.get_member(userid)) is not None:
+                    prize = prize_rng(rng)
+                    multiplier = self.bot.event_multiplier
+
+                    # Awarded in the same transaction the draw is recorded in
+                    new_scores = await self.bot.scores_repository.increment_many(
+                        {(guild.id, userid): prize * multiplier},
+                        [Increment(guild.id, userid, prize * multiplier,
+                                   multiplier, "Lottery prize",
+                                   self.qualified_name,
+                                   datetime.datetime.now(datetime.timezone.utc))],
+                        con=con,
                     )
-                    winner_increments.append((win_member, prize))
                 else:
                     logger.warn(
-                        f"Guild {guildid} didn't have announcement channel with id {lottery_channels[guildid]}"
+                        f"User {userid} not found in guild {guild.id} to give points"
                     )
-            else:
-                logger.warn(
-                    f"User {userid} not found in guild {guildid} to give points"
-                )
 
-        # do bulk increment with all winners
-        await self.scores.bulk_increment_scores(winner_increments,
-                                                reason="Lottery prizes")
+                await con.execute(
+                    "UPDATE lottery_draws SET winner = $3, prize = $4, drawn_at = CURRENT_TIMESTAMP "
+                    "WHERE guild = $1 AND draw_week = $2", guild.id,
+                    draw_week, userid, prize)
 
-        lottery_guilds = set(lottery_channels.keys())
-        winner_guilds = {rec["guild"] for rec in winners}
+            # clean up this week's tickets
+            await con.execute(
+                "DELETE FROM lottery WHERE guild = $1 AND draw_week = $2",
+                guild.id, draw_week)
+            await con.execute(
+                "DELETE FROM lottery_pools WHERE guild = $1 AND draw_week = $2",
+                guild.id, draw_week)
 
-        # send an announcement in guilds where no one entered this week
-        for guildid in lottery_guilds - winner_guilds:
-            guild = self.bot.get_guild(guildid)
-            announcement_chan = guild.get_channel(lottery_channels[guildid])
-            if announcement_chan is not None:
-                await announcement_chan.send(
-                    "No one entered the lottery this week :(\n"
-                    "Reminder that you can win up to 250 points and it only "
-                    "costs 20 points to buy a ticket! The next drawing is at "
-                    f"{next_draw_timestamp} so make sure to enter by then! :)")
-
-        # clean up purchased tickets in database
-        async with self.db_pool.acquire() as con:
-            await con.execute("TRUNCATE TABLE lottery")
+        if new_scores:
+            self.scores.scores_written(new_scores)
 
-        logger.debug("Cleared lottery db table")
+        next_draw_timestamp = f"<t:{int(self.next_draw_time.timestamp())}>"
+        announcement_chan = guild.get_channel(lottery_channel(guild.id))
 
-    @lottery_draw.before_loop
-    async def wait_until_draw(self):
-        await self.bot.wait_until_ready()
-        draw_datetime, passed = self.next_draw_time
-
-        # draw should have happened earlier the same day; do it now to not miss a week
-        # TODO: this breaks if the bot goes down multiple times on a draw day;
-        # maybe record draws in database/persistent storage somehow?
-        if passed:
-            logger.warn("Missed a draw; doing it now")
-            await self.lottery_draw()
-
-        # datetime.now() has to be called again in case lottery_draw took a while
-        logger.debug("Waiting until proper draw time")
-        seconds_until_draw = (
-            draw_datetime - datetime.now(ZoneInfo("America/Los_Angeles"))).total_seconds()
-        await asyncio.sleep(seconds_until_draw)
+        if announcement_chan is None:
+            logger.warn(
+                f"Guild {guild.id} didn't have announcement channel with id {lottery_channel(guild.id)}"
+            )
+
+        elif win_member is not None:
+            logger.debug(
+                f"{win_member.name} just won lottery in guild {guild.name}")
+            await announcement_chan.send(
+                f"{win_member.mention} just won **{prize}** points in the lottery! "
+                f"The next drawing will be at {next_draw_timestamp}, make sure to get your tickets by then!"
+            )
+
+        # send an announcement in guilds where no one entered this week
+        # (catching up a week that no one entered is done quietly)
+        elif not tickets and not catch_up:
+            await announcement_chan.send(
+                "No one entered the lottery this week :(\n"
+                "Reminder that you can win up to 250 points and it only "
+                "costs 20 points to buy a ticket! The next drawing is at "
+                f"{next_draw_timestamp} so make sure to enter by then! :)")
+
+        logger.info(
+            f"Drew lottery for week of {draw_week} in guild {guild.name} in "
+            f"{time.perf_counter() - start:.2f}s")
 
 
 async def setup(bot):
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+
+from discord.ext import commands
+
+logger = logging.getLogger(__name__)
+
+
+class GuildMembers(commands.Cog):
+    """Mirrors guild membership into the database.
+
+    This lets score queries join against the members that are still in a
+    guild instead of filtering out departed users afterwards.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.db_pool = bot.db_pool
+
+        # Set once every guild's members have been reconciled; anything that
+        # joins against guild_members on startup has to wait for this, since
+        # the table can be empty or out of date until then
+        self.members_reconciled = asyncio.Event()
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # Unavailable guilds have no members cached yet; they're reconciled
+        # once they become available
+        unavailable = []
+        for guild in self.bot.guilds:
+            if guild.unavailable:
+                unavailable.append(guild.id)
+            else:
+                await self.try_reconcile(guild)
+
+        self.members_reconciled.set()
+        logger.info("Reconciled guild member tables")
+
+        # Guilds that became available before the event was set
+        for guild_id in unavailable:
+            guild = self.bot.get_guild(guild_id)
+            if guild is not None and not guild.unavailable:
+                await self.guild_changed(guild)
+
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild):
+        await self.guild_changed(guild)
+
+    @commands.Cog.listener()
+    async def on_guild_available(self, guild):
+        # Guilds available at startup are reconciled by on_ready
+        if self.members_reconciled.is_set():
+            await self.guild_changed(guild)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        async with self.db_pool.acquire() as con:
+            await con.execute("DELETE FROM guild_members WHERE guild = $1",
+                              guild.id)
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member):
+        async with self.db_pool.acquire() as con:
+            await con.execute(
+                "INSERT INTO guild_members VALUES($1, $2) ON CONFLICT DO NOTHING",
+                member.guild.id,
+                member.id,
+            )
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member):
+        async with self.db_pool.acquire() as con:
+            await con.execute(
+                "DELETE FROM guild_members WHERE guild = $1 AND userid = $2",
+                member.guild.id,
+                member.id,
+            )
+
+    async def guild_changed(self, guild):
+        """Reconciles a guild's members after startup, then has its bonus
+        roles updated against them."""
+        if not await self.try_reconcile(guild):
+            return
+
+        if (bonus_cog := self.bot.get_cog("BonusRoles")) is not None:
+            bonus_cog.mark_dirty(guild.id)
+
+    async def try_reconcile(self, guild):
+        """Reconciles a guild's members, logging any failure so one guild
+        can't hold up the others. Returns whether it succeeded."""
+        try:
+            await self.reconcile_members(guild)
+        except Exception:
+            logger.exception(f"Failed to reconcile members of guild {guild.name}")
+            return False
+
+        return True
+
+    async def reconcile_members(self, guild):
+        """Brings a guild's mirrored members in line with its member cache."""
+        if not guild.chunked:
+            await guild.chunk()
+
+        # An empty cache means the members haven't been received, not that
+        # the guild has none; reconciling against it would delete them all
+        member_ids = [member.id for member in guild.members]
+        if not member_ids:
+            logger.warn(f"No members cached for guild {guild.name}; "
+                        "skipping member reconciliation")
+            return
+
+        async with self.db_pool.acquire() as con:
+            async with con.transaction():
+                removed = await con.execute(
+                    "DELETE FROM guild_members WHERE guild = $1 AND userid <> ALL($2::BIGINT[])",
+                    guild.id,
+                    member_ids,
+                )
+                added = await con.execute(
+                    "INSERT INTO guild_members (SELECT $1, unnest($2::BIGINT[])) "
+                    "ON CONFLICT DO NOTHING",
+                    guild.id,
+                    member_ids,
+                )
+
+        logger.debug(
+            f"Reconciled members of guild {guild.name} "
+            f"(added {added.split()[-1]}, removed {removed.split()[-1]})")
+
+
+async def setup(bot):
+    await bot.add_cog(GuildMembers(bot))
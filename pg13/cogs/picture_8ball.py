@@ -1,53 +1,118 @@
-import discord
 from discord.ext import commands
 
+import asyncio
 import logging
 import pathlib
 import random
 import re
 
+from ..uploads import upload_cache
+
 logger = logging.getLogger(__name__)
 
 # file name format: <name>-<weight>.png (or another file format ig)
 WEIGHT_RE = re.compile(r".+-(\d+)")
 
 
-def choose_response(response_dir):
+class AliasTable:
+    """Picks weighted random items in constant time (Vose's alias method).
+
+    Each slot holds an item, the probability of keeping it & an alias to
+    pick instead; building the table is linear in the number of items.
+    """
+
+    __slots__ = ("items", "probabilities", "aliases")
+
+    def __init__(self, items, weights):
+        count = len(items)
+        total = sum(weights)
+        scaled = [weight * count / total for weight in weights]
+
+        self.items = items
+        self.probabilities = [1.0] * count
+        self.aliases = list(range(count))
+
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.probabilities[less] = scaled[less]
+            self.aliases[less] = more
+
+            scaled[more] += scaled[less] - 1
+            (small if scaled[more] < 1 else large).append(more)
+
+    def choice(self, rng=random):
+        slot = rng.randrange(len(self.items))
+        if rng.random() < self.probabilities[slot]:
+            return self.items[slot]
+
+        return self.items[self.aliases[slot]]
+
+
+def build_response_table(response_dir):
     responses = []
-    cumulative_weights = [0]
+    weights = []
 
     for resp_file in response_dir.iterdir():
+        if (match := WEIGHT_RE.match(resp_file.name)) is None:
+            logger.warn(f"8ball response {resp_file} has no weight; skipping")
+            continue
+
         responses.append(resp_file)
+        weights.append(int(match.group(1)))
 
-        weight = int(WEIGHT_RE.match(resp_file.name).group(1))
-        cumulative_weights.append(cumulative_weights[-1] + weight)
+    if sum(weights) == 0:
+        return None
 
-    # only random.choices supports weights, so it's just used here to select a single element
-    return random.choices(responses, cum_weights=cumulative_weights[1:])[0]
+    return AliasTable(responses, weights)
 
 
 class Picture8Ball(commands.Cog):
 
+    def __init__(self):
+        # guild id -> (directory mtime, AliasTable) of each guild's responses,
+        # rebuilt whenever a response is added, removed or renamed
+        self.response_tables = {}
+
+    def response_table(self, guild_id):
+        """Returns a guild's response table, or None if it has no responses."""
+        response_dir = pathlib.Path(f"8ball/{guild_id}")
+
+        try:
+            mtime = response_dir.stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+        cached = self.response_tables.get(guild_id)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        table = build_response_table(response_dir)
+        self.response_tables[guild_id] = (mtime, table)
+        logger.debug(f"Indexed 8ball responses for guild {guild_id}")
+
+        return table
+
     @commands.command(
         name="ask",
         description="Receive an answer from the almighty oracle (me).")
     async def ask(self, ctx: commands.Context):
-        response_dir = pathlib.Path(f"8ball/{ctx.guild.id}")
-
-        if not response_dir.is_dir():
+        if (table := self.response_table(ctx.guild.id)) is None:
             await ctx.reply(
                 "I'm not configured to answer your questions in this server silly :)",
                 mention_author=False,
             )
 
         else:
-            response = choose_response(response_dir)
+            response = table.choice()
+            data = await asyncio.to_thread(response.read_bytes)
 
-            with open(response, "rb") as resp:
-                await ctx.reply(
-                    file=discord.File(resp, filename=response.name),
-                    mention_author=False,
-                )
+            await upload_cache.send_file(ctx.reply,
+                                         data,
+                                         response.name,
+                                         mention_author=False)
 
 
 async def setup(bot):
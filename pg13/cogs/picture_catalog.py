@@ -0,0 +1,153 @@
+import asyncio
+import logging
+import os
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+CATALOG_TABLES = [
+    # Every directory under a picture folder, with its mtime as of the last
+    # scan; a directory's mtime only changes when its own entries do
+    "CREATE TABLE IF NOT EXISTS directories"
+    "(path TEXT PRIMARY KEY, parent TEXT, mtime_ns INTEGER)",
+    "CREATE INDEX IF NOT EXISTS directories_parent_idx ON directories (parent)",
+
+    # Pictures are shown in order of their (random) position until all of
+    # them have been shown, then reshuffled
+    "CREATE TABLE IF NOT EXISTS pictures"
+    "(path TEXT PRIMARY KEY, directory TEXT, guild INTEGER, folder TEXT, "
+    "shown INTEGER DEFAULT 0, position INTEGER)",
+    "CREATE INDEX IF NOT EXISTS pictures_directory_idx ON pictures (directory)",
+    "CREATE INDEX IF NOT EXISTS pictures_rotation_idx "
+    "ON pictures (guild, folder, shown, position)",
+]
+
+
+def list_directory(directory):
+    """Returns the (picture paths, subdirectory paths) directly in `directory`."""
+    pictures = set()
+    subdirs = set()
+
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                subdirs.add(entry.path)
+            # same as the old rglob("*.*")
+            elif "." in entry.name:
+                pictures.add(entry.path)
+
+    return pictures, subdirs
+
+
+class PictureCatalog:
+    """A persistent index of the daily picture folders.
+
+    Folders are rescanned incrementally, only listing directories whose mtime
+    changed since the last scan, and each folder's pictures are handed out as
+    a shuffle bag so none repeats until every picture has been shown.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+
+    async def open(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.db = await aiosqlite.connect(self.path)
+        for statement in CATALOG_TABLES:
+            await self.db.execute(statement)
+        await self.db.commit()
+
+    async def close(self):
+        if self.db is not None:
+            await self.db.close()
+            self.db = None
+
+    async def rescan(self, guild_id, folder, root):
+        """Brings the catalog of a guild's picture folder up to date."""
+        pending = [str(root)]
+        listed = 0
+
+        while pending:
+            directory = pending.pop()
+            mtime = os.stat(directory).st_mtime_ns
+
+            known = await self.db.execute_fetchall(
+                "SELECT mtime_ns FROM directories WHERE path = ?",
+                (directory, ))
+            known_subdirs = {
+                row[0]
+                for row in await self.db.execute_fetchall(
+                    "SELECT path FROM directories WHERE parent = ?", (
+                        directory, ))
+            }
+
+            # Unchanged directories can only have changes further down
+            if known and known[0][0] == mtime:
+                pending.extend(known_subdirs)
+                continue
+
+            pictures, subdirs = await asyncio.to_thread(
+                list_directory, directory)
+            listed += 1
+
+            known_pictures = {
+                row[0]
+                for row in await self.db.execute_fetchall(
+                    "SELECT path FROM pictures WHERE directory = ?", (
+                        directory, ))
+            }
+
+            await self.db.executemany(
+                "DELETE FROM pictures WHERE path = ?",
+                [(path, ) for path in known_pictures - pictures])
+            await self.db.executemany(
+                "INSERT INTO pictures (path, directory, guild, folder, position) "
+                "VALUES(?, ?, ?, ?, random())",
+                [(path, directory, guild_id, folder)
+                 for path in pictures - known_pictures])
+
+            for removed in known_subdirs - subdirs:
+                await self.remove_tree(removed)
+
+            await self.db.execute(
+                "INSERT INTO directories VALUES(?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET mtime_ns = excluded.mtime_ns",
+                (directory, os.path.dirname(directory), mtime))
+            pending.extend(subdirs)
+
+        await self.db.commit()
+        logger.debug(
+            f"Rescanned picture folder {root} ({listed} directories listed)")
+
+    async def remove_tree(self, directory):
+        pattern = directory.replace("%", r"\%").replace("_", r"\_") + "/%"
+        await self.db.execute(
+            "DELETE FROM pictures WHERE directory = ? OR directory LIKE ? ESCAPE '\\'",
+            (directory, pattern))
+        await self.db.execute(
+            "DELETE FROM directories WHERE path = ? OR path LIKE ? ESCAPE '\\'",
+            (directory, pattern))
+
+    async def next_picture(self, guild_id, folder):
+        """Returns the path of a folder's next picture, or None if it's empty."""
+        for _ in range(2):
+            rows = await self.db.execute_fetchall(
+                "SELECT path FROM pictures WHERE guild = ? AND folder = ? AND NOT shown "
+                "ORDER BY position LIMIT 1", (guild_id, folder))
+            if rows:
+                return rows[0][0]
+
+            # Every picture has been shown; start a new shuffled round
+            await self.db.execute(
+                "UPDATE pictures SET shown = 0, position = random() "
+                "WHERE guild = ? AND folder = ?", (guild_id, folder))
+            await self.db.commit()
+
+        return None
+
+    async def mark_shown(self, path):
+        await self.db.execute("UPDATE pictures SET shown = 1 WHERE path = ?",
+                              (path, ))
+        await self.db.commit()
@@ -0,0 +1,97 @@
+import bisect
+
+
+class LeaderboardSnapshot:
+    """An immutable copy of a guild's ranking at some version.
+
+    Snapshots are shared by every leaderboard open in a guild, so paging is
+    just a slice of `entries` and rendered pages can be reused between views.
+    """
+
+    __slots__ = ("version", "entries", "rendered_pages")
+
+    def __init__(self, version, entries):
+        self.version = version
+        # (userid, score) pairs, best first
+        self.entries = tuple(entries)
+        self.rendered_pages = {}
+
+    def page_count(self, page_size):
+        return max(-(-len(self.entries) // page_size), 1)
+
+    def page(self, number, page_size):
+        return self.entries[number * page_size:(number + 1) * page_size]
+
+
+class GuildRanking:
+    """Keeps the scores of a guild's members sorted for fast rank lookups.
+
+    Entries are ranked like the leaderboard (score DESC, userid DESC), but
+    they're stored ascending as (score, userid) tuples so they can be searched
+    with bisect.
+    """
+
+    def __init__(self, entries=()):
+        # `entries` has to already be sorted in ascending order
+        self.entries = list(entries)
+        self.scores = {userid: score for score, userid in self.entries}
+
+        # Bumped on every change so stale snapshots can be detected
+        self.version = 0
+        self._snapshot = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def set_score(self, userid, score):
+        if self.scores.get(userid) == score:
+            return
+
+        self.remove(userid)
+        bisect.insort(self.entries, (score, userid))
+        self.scores[userid] = score
+        self.version += 1
+
+    def remove(self, userid):
+        if (score := self.scores.pop(userid, None)) is not None:
+            del self.entries[bisect.bisect_left(self.entries,
+                                                (score, userid))]
+            self.version += 1
+
+    def rank(self, userid):
+        """Returns a user's (1-based) place, or None if they have no score."""
+        if (score := self.scores.get(userid)) is None:
+            return None
+
+        return len(self.entries) - bisect.bisect_left(self.entries,
+                                                      (score, userid))
+
+    def slice(self, start, stop):
+        """Returns the (userid, score) pairs from place start + 1 to stop."""
+        total = len(self.entries)
+        start = min(max(start, 0), total)
+        stop = min(max(stop, start), total)
+
+        return [(userid, score) for score, userid in reversed(
+            self.entries[total - stop:total - start])]
+
+    def snapshot(self):
+        """Returns a snapshot of the current ranking, reusing the last one
+        if nothing changed since it was taken."""
+        if self._snapshot is None or self._snapshot.version != self.version:
+            self._snapshot = LeaderboardSnapshot(
+                self.version,
+                ((userid, score) for score, userid in reversed(self.entries)))
+
+        return self._snapshot
+
+    def top(self, count):
+        return self.slice(0, count)
+
+    def around(self, userid, radius):
+        """Returns the starting place and entries of the users near a user."""
+        if (place := self.rank(userid)) is None:
+            return None, []
+
+        start = max(place - 1 - radius, 0)
+        return start + 1, self.slice(start, place + radius)
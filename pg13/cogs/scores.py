@@ -1,18 +1,26 @@
+import asyncio
 import collections
+import datetime
 import itertools
 import logging
 
-import asyncpg
 import discord
 from discord import app_commands
-from discord.ext import commands
+from discord.ext import commands, tasks
 
 from .checks import admin_check
-from .views import Leaderboard
+from .ranking import GuildRanking
+from .views import LeaderboardButton, leaderboard_page
+from ..config import write_behind
+from ..db.scores import add_month
 
 logger = logging.getLogger(__name__)
 
-Increment = collections.namedtuple("Increment", ["guild", "userid", "points"])
+Increment = collections.namedtuple(
+    "Increment",
+    ["guild", "userid", "points", "multiplier", "reason", "source",
+     "created_at"],
+)
 
 
 def make_ordinal(n):
@@ -33,18 +41,185 @@ def make_ordinal(n):
     return str(n) + suffix
 
 
+def member_ranking(guild, rows):
+    """Ranks the current members of a guild among ascending score rows."""
+    return GuildRanking((row["score"], row["userid"]) for row in rows
+                        if guild.get_member(row["userid"]) is not None)
+
+
 class Scores(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
         self.db_pool = bot.db_pool
+        self.repository = bot.scores_repository
+
+        # Score increments waiting to be written, keyed by (guild, userid),
+        # along with their (uncoalesced) ledger entries
+        self.pending_increments = collections.Counter()
+        self.pending_ledger = []
+        self.buffer_increments = write_behind.get("enabled", False)
+        self.max_pending = write_behind.get("max_pending", 500)
+
+        # Per-guild rankings of current members, loaded once the bot is ready
+        self.rankings = collections.defaultdict(GuildRanking)
+
+        # (guild id or None for all guilds, updates) of each ranking load in
+        # progress, collecting the updates to replay over its snapshot
+        self.loading_updates = []
+        self.listen_con = None
+        self.relisten_task = None
 
     async def cog_load(self):
-        async with self.db_pool.acquire() as con:
-            await con.execute(
-                "CREATE TABLE IF NOT EXISTS scores"
-                "(guild BIGINT, userid BIGINT, score INT, UNIQUE(guild, userid))"
-            )
+        await self.listen()
+
+        await self.create_ledger_partitions()
+        self.create_ledger_partitions.start()
+
+        # Handles leaderboard button presses, including on messages sent
+        # before a restart
+        self.bot.add_dynamic_items(LeaderboardButton)
+
+        if self.buffer_increments:
+            self.flush_pending.change_interval(
+                seconds=write_behind.get("max_staleness", 5))
+            self.flush_pending.start()
+
+    async def cog_unload(self):
+        # Make sure buffered increments aren't lost when shutting down
+        self.flush_pending.cancel()
+        self.create_ledger_partitions.cancel()
+        self.bot.remove_dynamic_items(LeaderboardButton)
+        await self.flush_increments()
+
+        if self.relisten_task is not None:
+            self.relisten_task.cancel()
+        self.listen_con.remove_termination_listener(self.on_listen_terminated)
+        await self.listen_con.remove_listener("score_changes",
+                                              self.on_score_notification)
+        await self.db_pool.release(self.listen_con)
+
+    async def listen(self):
+        # This connection is held for as long as the cog is loaded
+        self.listen_con = await self.db_pool.acquire()
+        await self.listen_con.add_listener("score_changes",
+                                           self.on_score_notification)
+        self.listen_con.add_termination_listener(self.on_listen_terminated)
+
+    def on_listen_terminated(self, con):
+        logger.warn("Lost the score notification connection; reconnecting")
+        self.relisten_task = asyncio.ensure_future(self.relisten(con))
+
+    async def relisten(self, con):
+        await self.db_pool.release(con)
+
+        while True:
+            try:
+                await self.listen()
+                break
+            except Exception:
+                logger.exception("Failed to listen for score notifications")
+                await asyncio.sleep(5)
+
+        # Notifications sent while disconnected were missed
+        if self.bot.is_ready():
+            await self.load_rankings()
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        await self.load_rankings()
+
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild):
+        await self.load_guild_ranking(guild)
+
+    @commands.Cog.listener()
+    async def on_guild_available(self, guild):
+        # Guilds available at startup are loaded by on_ready
+        if self.bot.is_ready():
+            await self.load_guild_ranking(guild)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        self.rankings.pop(guild.id, None)
+
+    async def recording_updates(self, guild_id, fetch):
+        """Awaits `fetch`, returning its result along with the ranking updates
+        made meanwhile in the guild (or every guild if `guild_id` is None).
+
+        Notifications keep arriving while scores are fetched; the updates
+        they make have to be replayed so the snapshot doesn't undo them.
+        """
+        loading = (guild_id, [])
+        self.loading_updates.append(loading)
+        try:
+            result = await fetch
+        finally:
+            self.loading_updates.remove(loading)
+
+        return result, loading[1]
+
+    async def load_rankings(self):
+        all_scores, updates = await self.recording_updates(
+            None, self.repository.all_scores())
+
+        # rows are already in ascending order
+        guild_scores = {
+            guild_id: list(rows)
+            for guild_id, rows in itertools.groupby(
+                all_scores, key=lambda row: row["guild"])
+        }
+
+        # Unavailable guilds have no members cached yet; they're loaded once
+        # they become available
+        available = [guild for guild in self.bot.guilds if not guild.unavailable]
+        for guild in available:
+            self.rankings[guild.id] = member_ranking(
+                guild, guild_scores.get(guild.id, ()))
+
+        for update in updates:
+            self.update_ranking(*update)
+
+        logger.info(f"Loaded score rankings for {len(available)} guilds "
+                    f"({len(updates)} updates replayed)")
+
+    async def load_guild_ranking(self, guild):
+        rows, updates = await self.recording_updates(
+            guild.id, self.repository.guild_scores(guild.id))
+
+        self.rankings[guild.id] = member_ranking(guild, rows)
+        for update in updates:
+            self.update_ranking(*update)
+
+        logger.debug(f"Loaded score ranking for guild {guild.name}")
+
+    def update_ranking(self, guild_id, userid, score):
+        for loading_guild, updates in self.loading_updates:
+            if loading_guild is None or loading_guild == guild_id:
+                updates.append((guild_id, userid, score))
+
+        if (guild := self.bot.get_guild(guild_id)) is None:
+            return
+
+        if guild.get_member(userid) is not None:
+            self.rankings[guild_id].set_score(userid, score)
+        else:
+            self.rankings[guild_id].remove(userid)
+
+    def on_score_notification(self, con, pid, channel, payload):
+        # payload has the form `guild userid score`
+        guild_id, userid, score = map(int, payload.split())
+        self.update_ranking(guild_id, userid, score)
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member):
+        score = await self.repository.get_score(member.guild.id, member.id)
+        if score is not None:
+            self.rankings[member.guild.id].set_score(member.id, score)
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member):
+        self.rankings[member.guild.id].remove(member.id)
 
     score_group = app_commands.Group(
         name="score",
@@ -56,8 +231,10 @@ class Scores(commands.Cog):
         description="Display the score leaderboard for the current server.",
     )
     async def leaderboard(self, interaction: discord.Interaction):
-        leaderboard_view = Leaderboard(interaction.guild, self.db_pool)
-        await leaderboard_view.init_leaderboard(interaction)
+        embed, view = leaderboard_page(interaction.guild,
+                                       self.rankings[interaction.guild_id],
+                                       interaction.user.id, 0)
+        await interaction.response.send_message(embed=embed, view=view)
 
     @app_commands.command(
         name="total",
@@ -65,10 +242,7 @@ class Scores(commands.Cog):
         "Check the total amount of points of members of this server.",
     )
     async def total(self, interaction: discord.Interaction):
-        async with self.db_pool.acquire() as con:
-            guild_total = await con.fetchval(
-                "SELECT sum(score) FROM scores WHERE guild = $1",
-                interaction.guild_id)
+        guild_total = await self.repository.guild_total(interaction.guild_id)
 
         if guild_total is None:
             await interaction.response.send_message(
@@ -81,11 +255,14 @@ class Scores(commands.Cog):
         name="rank",
         description="Display a user's rank & score in this server.",
     )
-    @app_commands.describe(user="The user to display the rank of (default you)"
-                           )
+    @app_commands.describe(
+        user="The user to display the rank of (default you)",
+        nearby="Whether to also show the users ranked around them",
+    )
     async def rank(self,
                    interaction: discord.Interaction,
-                   user: discord.Member = None):
+                   user: discord.Member = None,
+                   nearby: bool = False):
         if user is None:
             user = interaction.user
 
@@ -93,35 +270,28 @@ class Scores(commands.Cog):
             return await interaction.response.send_message(
                 "Bots can't get points silly :)", ephemeral=True)
 
-        async with self.db_pool.acquire() as con:
-            at_least_equal = await con.fetch(
-                "WITH guild_scores AS (SELECT score, userid FROM scores WHERE guild = $1), "
-                "user_score as (SELECT score FROM guild_scores WHERE userid = $2) "
-                "SELECT score, userid FROM guild_scores WHERE score >= (SELECT score FROM user_score) "
-                "ORDER BY score DESC",
-                interaction.guild_id,
-                user.id,
-            )
-
-        if not at_least_equal:
+        ranking = self.rankings[interaction.guild_id]
+        if (place := ranking.rank(user.id)) is None:
             return await interaction.response.send_message(
                 "That user doesn't have any points yet.", ephemeral=True)
 
-        user_score = at_least_equal[-1]["score"]
+        user_score = ranking.scores[user.id]
+        rank_message = f"{user.name} is in **{make_ordinal(place)} place** with **{user_score}** points."
 
-        in_guild = [
-            member.id for row in at_least_equal
-            if (member := interaction.guild.get_member(row["userid"])
-                ) is not None
-        ]
-        members_ahead = list(
-            itertools.takewhile(lambda member_id: member_id != user.id,
-                                in_guild))
-        place = len(members_ahead) + 1
+        if not nearby:
+            return await interaction.response.send_message(rank_message)
+
+        start, neighbours = ranking.around(user.id, 3)
+        nearby_lines = []
+        for neighbour_place, (userid, score) in enumerate(neighbours,
+                                                          start=start):
+            name = getattr(interaction.guild.get_member(userid),
+                           "display_name", "<unknown member>")
+            nearby_lines.append(f"{neighbour_place}: {name} - {score}")
 
         await interaction.response.send_message(
-            f"{user.name} is in **{make_ordinal(place)} place** with **{user_score}** points."
-        )
+            rank_message,
+            embed=discord.Embed(description="\n".join(nearby_lines)))
 
     @score_group.command(
         name="set",
@@ -136,21 +306,23 @@ class Scores(commands.Cog):
             return await interaction.response.send(
                 f"{user.name} is a bot and cannot get points.", ephemeral=True)
 
+        # Buffered increments have to land first so the ledger entry below
+        # records the right difference
+        await self.flush_increments()
+
         # Update user's score in guild database table
-        async with self.db_pool.acquire() as con:
-            await con.execute(
-                f"INSERT INTO scores VALUES($1, $2, $3) "
-                f"ON CONFLICT(guild, userid) DO UPDATE SET score = EXCLUDED.score",
-                interaction.guild_id,
-                user.id,
-                score,
-            )
+        await self.repository.set_score(interaction.guild_id,
+                                        user.id,
+                                        score,
+                                        reason="Score set",
+                                        source=self.qualified_name)
 
+        self.rankings[interaction.guild_id].set_score(user.id, score)
         logger.debug(f"Updated {user.name}'s score to {score}")
 
         # Update bonus roles, if applicable
         if (bonus_cog := self.bot.get_cog("BonusRoles")) is not None:
-            await bonus_cog.update_bonus_roles(user.guild)
+            bonus_cog.score_changed(interaction.guild_id, user.id, score)
 
         await interaction.response.send_message(
             f"Successfully updated {user.name}'s score to **{score}**!")
@@ -171,7 +343,10 @@ class Scores(commands.Cog):
                 f"{user.name} is a bot and cannot get points.")
 
         # Update scores in database
-        await self.increment_score(user, points, reason="User score adjusted")
+        await self.increment_score(user,
+                                   points,
+                                   reason="User score adjusted",
+                                   source=self.qualified_name)
 
         # Incrementing user score
         if points >= 0:
@@ -183,49 +358,36 @@ class Scores(commands.Cog):
             await interaction.response.send_message(
                 f"Took {-points} points from {user.name}!")
 
-    # TODO: interact with scores database through functions like this instead
-    # of directly?
-    async def get_score(self, con: asyncpg.Connection, userid: int,
-                        guildid: int):
-        """Gets a user's score in the provided guild.
-
-        Returns None if they have no points yet.
-        """
-        return con.fetchval(
-            "SELECT score FROM scores WHERE userid = $1 AND guild = $2",
-            userid,
-            guildid,
-        )
-
     async def increment_score(self,
                               member: discord.Member,
                               points,
-                              reason=None):
-        await self.bulk_increment_scores([(member, points)], reason)
-
-    async def bulk_increment_scores(self, increments, reason=None):
+                              reason=None,
+                              source=None):
+        await self.bulk_increment_scores([(member, points)], reason, source)
+
+    async def bulk_increment_scores(self,
+                                    increments,
+                                    reason=None,
+                                    source=None):
         """Changes a user's score by some amount.
 
-        `increments` should be a list of (discord.Member, points) tuples
+        `increments` should be a list of (discord.Member, points) tuples, and
+        `source` the name of the cog the points came from
         """
 
         # take into account event multiplier
         multiplier = self.bot.event_multiplier
+        # ledger entries keep the time of the change, not of a later flush
+        now = datetime.datetime.now(datetime.timezone.utc)
         db_increments = [
-            Increment(member.guild.id, member.id, points * multiplier)
+            Increment(member.guild.id, member.id, points * multiplier,
+                      multiplier, reason, source, now)
             for member, points in increments
         ]
 
-        async with self.db_pool.acquire() as con:
-            await con.executemany(
-                "INSERT INTO scores VALUES($1, $2, $3) ON CONFLICT(guild, userid) "
-                "DO UPDATE SET score = scores.score + $3",
-                db_increments,
-            )
-
-        # logging & bonus role updates
-        bonus_roles = self.bot.get_cog("BonusRoles")
-        grouped = itertools.groupby(sorted(db_increments),
+        # logging
+        grouped = itertools.groupby(sorted(db_increments,
+                                           key=lambda inc: inc.guild),
                                     key=lambda inc: inc.guild)
         for guild_id, guild_increments in grouped:
             reason_chunk = f" (reason: {reason})" if reason is not None else ""
@@ -235,9 +397,86 @@ class Scores(commands.Cog):
                 f"Scores in guild {guild_id} updated{reason_chunk}: {affected_users}"
             )
 
+        coalesced = collections.Counter()
+        for inc in db_increments:
+            coalesced[(inc.guild, inc.userid)] += inc.points
+
+        if not self.buffer_increments:
+            await self.write_increments(coalesced, db_increments)
+            return
+
+        self.pending_increments.update(coalesced)
+        self.pending_ledger.extend(db_increments)
+        if len(self.pending_increments) >= self.max_pending:
+            await self.flush_increments()
+
+    async def flush_increments(self):
+        """Writes all buffered score increments to the database."""
+        if not self.pending_increments:
+            return
+
+        # Swap the buffer out so increments arriving mid-flush aren't lost
+        pending = self.pending_increments
+        pending_ledger = self.pending_ledger
+        self.pending_increments = collections.Counter()
+        self.pending_ledger = []
+
+        try:
+            await self.write_increments(pending, pending_ledger)
+        except Exception:
+            # Put everything back to be retried on the next flush
+            self.pending_increments.update(pending)
+            self.pending_ledger[:0] = pending_ledger
+            raise
+
+        logger.debug(f"Flushed buffered increments for {len(pending)} users")
+
+    async def write_increments(self, increments, ledger_entries):
+        """Writes coalesced increments & their ledger entries to the database.
+
+        `increments` should map (guild, userid) tuples to point totals, and
+        `ledger_entries` be a list of the Increments they were built from
+        """
+        if not increments:
+            return
+
+        new_scores = await self.repository.increment_many(
+            increments, ledger_entries)
+        self.scores_written(new_scores)
+
+    def scores_written(self, new_scores):
+        """Updates everything derived from scores after they were written.
+
+        `new_scores` should be a list of rows with guild, userid & score keys;
+        this is also used by cogs that write scores through their own queries.
+        """
+        bonus_roles = self.bot.get_cog("BonusRoles")
+        for row in new_scores:
+            self.update_ranking(row["guild"], row["userid"], row["score"])
+
+            # bonus roles are updated in the background, if at all
             if bonus_roles is not None:
-                affected_guild = self.bot.get_guild(guild_id)
-                await bonus_roles.update_bonus_roles(affected_guild)
+                bonus_roles.score_changed(row["guild"], row["userid"],
+                                          row["score"])
+
+    @tasks.loop(seconds=5)
+    async def flush_pending(self):
+        # An error would otherwise stop the loop for good; the increments are
+        # put back by flush_increments and retried on the next run
+        try:
+            await self.flush_increments()
+        except Exception:
+            logger.exception("Failed to flush buffered score increments")
+
+    @tasks.loop(time=datetime.time(0, 0))
+    async def create_ledger_partitions(self):
+        """Makes sure ledger partitions exist for this month and the next."""
+        this_month = datetime.date.today().replace(day=1)
+        await self.repository.create_ledger_partitions(
+            [this_month, add_month(this_month)])
+
+    async def detach_ledger_partitions(self, before):
+        return await self.repository.detach_ledger_partitions(before)
 
 
 async def setup(bot):
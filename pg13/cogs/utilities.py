@@ -1,9 +1,13 @@
+import datetime
 import logging
 
 import aiosqlite
 import discord
 from discord.ext import commands
 
+from .dailies import claim_day
+from .. import metrics
+
 logger = logging.getLogger(__name__)
 
 
@@ -78,14 +82,17 @@ class Utilities(commands.Cog):
                 table_contents = await dailies.execute_fetchall(
                     f"SELECT * FROM {table['name']}")
 
-                # Channel bonus claims
+                # Channel bonus claims (the old tables only held today's)
                 if table["name"].startswith("channel_"):
                     channel_id = int(table["name"][8:])
+                    guild_id = channel_guilds[channel_id]
+                    today = claim_day(guild_id)
                     new_claims = map(
                         lambda row: (
                             channel_id,
-                            channel_guilds[channel_id],
+                            guild_id,
                             row["user"],
+                            today,
                         ),
                         table_contents,
                     )
@@ -94,8 +101,10 @@ class Utilities(commands.Cog):
                 # `/daily claim` claims
                 elif table["name"].startswith("bonus_"):
                     guild_id = int(table["name"][6:])
-                    new_claims = map(lambda row: (guild_id, row["user"]),
-                                     table_contents)
+                    today = claim_day(guild_id)
+                    new_claims = map(
+                        lambda row: (guild_id, row["user"], 0, today),
+                        table_contents)
                     daily_claims.extend(new_claims)
 
                 # DoorToDarkness claims (ignored because cog is no longer in use)
@@ -108,8 +117,8 @@ class Utilities(commands.Cog):
         # Writing to the Postgres database
         async with self.db_pool.acquire() as con:
             # scores
-            await con.executemany("INSERT INTO scores VALUES($1, $2, $3)",
-                                  score_rows)
+            await self.bot.scores_repository.import_scores(score_rows,
+                                                           con=con)
 
             # dailies
             await con.executemany(
@@ -117,14 +126,54 @@ class Utilities(commands.Cog):
                 channel_bonuses,
             )
             await con.executemany(
-                "INSERT INTO channel_claims VALUES($1, $2, $3)",
+                "INSERT INTO channel_claims VALUES($1, $2, $3, $4)",
                 channel_claims)
-            await con.executemany("INSERT INTO daily_claims VALUES($1, $2)",
-                                  daily_claims)
+            await con.executemany(
+                "INSERT INTO daily_claims VALUES($1, $2, $3, $4)",
+                daily_claims)
 
         logger.info("Databases successfully migrated to PostgreSQL")
         await ctx.message.add_reaction("✅")
 
+    @commands.command(
+        description="Detach score ledger partitions older than some months")
+    async def detachledger(self, ctx: commands.Context, keep_months: int):
+        if keep_months < 1:
+            return await ctx.reply(
+                "You have to keep at least the current month :)",
+                mention_author=False)
+
+        if (scores_cog := self.bot.get_cog("Scores")) is None:
+            return await ctx.message.add_reaction("❌")
+
+        # First day of the oldest month to keep (including the current one)
+        cutoff = datetime.date.today().replace(day=1)
+        for _ in range(keep_months - 1):
+            cutoff = (cutoff - datetime.timedelta(days=1)).replace(day=1)
+
+        detached = await scores_cog.detach_ledger_partitions(cutoff)
+
+        logger.info(f"Detached score ledger partitions: {detached}")
+        await ctx.message.add_reaction("✅")
+
+    @commands.command(
+        description="Rebuild per-guild score totals from the scores table")
+    async def rebuildtotals(self, ctx: commands.Context):
+        await self.bot.scores_repository.rebuild_totals()
+
+        logger.info("Rebuilt guild score totals")
+        await ctx.message.add_reaction("✅")
+
+    @commands.command(name="metrics", description="Show in-process metrics")
+    async def show_metrics(self, ctx: commands.Context):
+        lines = [f"{name}: {value}" for name, value in sorted(
+            metrics.counters.items())]
+        lines.extend(f"{name}: {summary}"
+                     for name, summary in sorted(metrics.summaries.items()))
+
+        await ctx.reply("\n".join(lines) or "No metrics recorded yet :)",
+                        mention_author=False)
+
     async def cog_check(self, ctx: commands.Context):
         return await ctx.bot.is_owner(ctx.author)
 
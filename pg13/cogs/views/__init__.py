@@ -1 +1 @@
-from .leaderboard import Leaderboard
+from .leaderboard import LeaderboardButton, leaderboard_page
@@ -1,222 +1,122 @@
-import collections
-import functools
 import logging
 
 import discord
 
-ScoreInfo = collections.namedtuple("ScoreInfo", ["member", "score"])
-
 logger = logging.getLogger(__name__)
 
+PAGE_SIZE = 15
+
+
+def render_page(guild, snapshot, page):
+    """Renders a page of a leaderboard snapshot, reusing earlier renders."""
+    if (rendered := snapshot.rendered_pages.get(page)) is not None:
+        return rendered
+
+    lines = []
+    for place, (userid, score) in enumerate(snapshot.page(page, PAGE_SIZE),
+                                            start=page * PAGE_SIZE + 1):
+        # The member cache can briefly lag behind the ranking
+        if (member := guild.get_member(userid)) is not None:
+            lines.append(f"{place}: {member.display_name} - {score}\n")
+
+    rendered = snapshot.rendered_pages[page] = "".join(lines)
+    return rendered
+
+
+def leaderboard_page(guild, ranking, owner_id, page):
+    """Builds the embed & buttons for a page of a guild's leaderboard.
+
+    Everything needed to handle a button press is encoded in its custom_id,
+    so no per-leaderboard state is kept around after this returns.
+    """
+    snapshot = ranking.snapshot()
+
+    # The leaderboard may have shrunk since the last page was shown
+    last_page = snapshot.page_count(PAGE_SIZE) - 1
+    page = min(max(page, 0), last_page)
+
+    view = discord.ui.View(timeout=None)
+    view.add_item(
+        LeaderboardButton("left",
+                          guild.id,
+                          owner_id,
+                          page - 1,
+                          disabled=page == 0))
+    view.add_item(
+        LeaderboardButton("right",
+                          guild.id,
+                          owner_id,
+                          page + 1,
+                          disabled=page == last_page))
+    view.add_item(LeaderboardButton("me", guild.id, owner_id, page))
+
+    # A stopped view isn't kept in discord.py's view store; presses are
+    # routed to LeaderboardButton through its custom_id template instead
+    view.stop()
+
+    embed = discord.Embed(title=f"{guild.name} Leaderboard",
+                          description=render_page(guild, snapshot, page))
+    return embed, view
+
+
+class LeaderboardButton(
+        discord.ui.DynamicItem[discord.ui.Button],
+        template=r"leaderboard:(?P<action>left|right|me):"
+        r"(?P<guild>[0-9]+):(?P<owner>[0-9]+):(?P<page>-?[0-9]+)",
+):
+    """A leaderboard button that survives restarts.
+
+    `page` is the page to show when pressed (or the current page for the
+    jump-to-me button), and `owner` the only user allowed to press it.
+    """
+
+    EMOJI = {"left": "⬅️", "right": "➡️", "me": "📍"}
+
+    def __init__(self, action, guild_id, owner_id, page, disabled=False):
+        super().__init__(
+            discord.ui.Button(
+                emoji=self.EMOJI[action],
+                custom_id=
+                f"leaderboard:{action}:{guild_id}:{owner_id}:{page}",
+                disabled=disabled,
+            ))
+        self.action = action
+        self.guild_id = guild_id
+        self.owner_id = owner_id
+        self.page = page
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(
+            match["action"],
+            int(match["guild"]),
+            int(match["owner"]),
+            int(match["page"]),
+        )
 
-def build_leaderboard(base_str, member_info):
-    place = member_info[0]
-    score_info = member_info[1]
-
-    return (
-        base_str +
-        f"{place}: {score_info.member.display_name} - {score_info.score}\n")
-
-
-def calculate_offset(bundles, users_needed):
-    valid_members = []
-    total_users = 0
-
-    for bundle in bundles:
-        if bundle.member is not None:
-            valid_members.append(bundle)
-
-        total_users += 1
-
-        if len(valid_members) == users_needed:
-            break
-
-    return valid_members, total_users
+    async def callback(self, interaction: discord.Interaction):
+        # Ensure that only the original author can interact with a leaderboard
+        if interaction.user.id != self.owner_id:
+            return await interaction.response.send_message(
+                "That's not your leaderboard :)", ephemeral=True)
 
+        if (scores_cog := interaction.client.get_cog("Scores")) is None:
+            return await interaction.response.send_message(
+                "Leaderboards aren't available right now :(", ephemeral=True)
 
-class Leaderboard(discord.ui.View):
+        if (guild := interaction.client.get_guild(self.guild_id)) is None:
+            return await interaction.response.send_message(
+                "That server isn't available right now :(", ephemeral=True)
 
-    def __init__(self, guild, db_pool):
-        super().__init__()
-        self.guild = guild
-        self.db_pool = db_pool
-        self.page = 0
-        self.offsets = [0]
+        ranking = scores_cog.rankings[self.guild_id]
+        page = self.page
 
-    @property
-    def current_offset(self):
-        return self.offsets[self.page]
+        if self.action == "me":
+            if (place := ranking.rank(interaction.user.id)) is None:
+                return await interaction.response.send_message(
+                    "You don't have any points yet :)", ephemeral=True)
 
-    @property
-    def next_offset(self):
-        return self.offsets[self.page + 1]
+            page = (place - 1) // PAGE_SIZE
 
-    async def interaction_check(self, interaction: discord.Interaction):
-        # Ensure that only the original author can interact with a leaderboard
-        return interaction.user.id == self.leaderboard_user
-
-    async def init_leaderboard(self, interaction):
-        self.leaderboard_user = interaction.user.id
-
-        async with self.db_pool.acquire() as con:
-            user_scores = await con.fetch(
-                "SELECT userid, score FROM scores WHERE guild = $1 "
-                "ORDER BY score DESC, userid DESC FETCH NEXT 30 ROWS ONLY",
-                self.guild.id,
-            )
-
-        bundled_users = [
-            ScoreInfo(self.guild.get_member(row["userid"]), row["score"])
-            for row in user_scores
-        ]
-        valid_users, next_offset = calculate_offset(bundled_users, 15)
-        self.current_users = valid_users
-        self.offsets.append(next_offset)
-
-        valid_next_users, lookahead = calculate_offset(
-            bundled_users[next_offset:], 15)
-        self.next_users = valid_next_users
-        self.lookahead_length = lookahead
-
-        self.leaderboard_right.disabled = len(self.next_users) == 0
-
-        leaderboard = functools.reduce(build_leaderboard,
-                                       enumerate(self.current_users, start=1),
-                                       "")
-        leaderboard_embed = discord.Embed(
-            title=f"{self.guild.name} Leaderboard", description=leaderboard)
-        await interaction.response.send_message(embed=leaderboard_embed,
-                                                view=self)
-
-        # Store a reference to the leaderboard message for cleanup purposes
-        self.message = await interaction.original_response()
-
-    async def update(self, interaction):
-        self.leaderboard_left.disabled = self.offsets[self.page] == 0
-        self.leaderboard_right.disabled = len(self.next_users) == 0
-
-        leaderboard = functools.reduce(
-            build_leaderboard,
-            enumerate(self.current_users, start=self.page * 15 + 1),
-            "",
-        )
-        leaderboard_embed = discord.Embed(
-            title=f"{self.guild.name} Leaderboard", description=leaderboard)
-        await interaction.response.edit_message(embed=leaderboard_embed,
-                                                view=self)
-
-    async def on_timeout(self):
-        # Disable the buttons after the leaderboard expires
-        self.leaderboard_left.disabled = True
-        self.leaderboard_right.disabled = True
-        await self.message.edit(view=self)
-
-    @discord.ui.button(emoji="⬅️", custom_id="leaderboard:left", disabled=True)
-    async def leaderboard_left(self, interaction: discord.Interaction,
-                               button: discord.ui.Button):
-        self.lookahead_length = len(self.next_users)
-        self.next_users = self.current_users
-        self.page -= 1
-
-        async with self.db_pool.acquire() as con:
-            unbundled_current = await con.fetch(
-                "SELECT userid, score FROM scores WHERE guild = $1 "
-                "ORDER BY score DESC, userid DESC OFFSET $2 ROWS FETCH NEXT $3 ROWS ONLY",
-                self.guild.id,
-                self.current_offset,
-                self.next_offset - self.current_offset,
-            )
-
-        self.current_users = [
-            ScoreInfo(member, row["score"]) for row in unbundled_current
-            if (member := self.guild.get_member(row["userid"])) is not None
-        ]
-
-        await self.update(interaction)
-
-    @discord.ui.button(emoji="➡️", custom_id="leaderboard:right")
-    async def leaderboard_right(self, interaction: discord.Interaction,
-                                button: discord.ui.Button):
-        self.current_users = self.next_users
-        self.page += 1
-
-        # Offset already exists for 2 pages forward (i.e. already visited next page)
-        if len(self.offsets) > self.page + 2:
-            # Reached the end of the leaderboard
-            if self.offsets[self.page + 2] == -1:
-                self.next_users = []
-
-            else:
-                async with self.db_pool.acquire() as con:
-                    unbundled_next = await con.fetch(
-                        "SELECT userid, score FROM scores WHERE guild = $1 "
-                        "ORDER BY score DESC, userid DESC OFFSET $2 ROWS FETCH NEXT $3 ROWS ONLY",
-                        self.guild.id,
-                        self.next_offset,
-                        self.offsets[self.page + 2] - self.next_offset,
-                    )
-
-                # This is theoretically guaranteed to be 15 users
-                self.next_users = [
-                    ScoreInfo(member, row["score"]) for row in unbundled_next
-                    if (member := self.guild.get_member(row["userid"])
-                        ) is not None
-                ]
-
-        # Visiting new pages
-        else:
-            # Need to complete current (displayed) page
-            if len(self.current_users) < 15:
-                async with self.db_pool.acquire() as con:
-                    unbundled_complement = await con.fetch(
-                        "SELECT userid, score FROM scores WHERE guild = $1 "
-                        "ORDER BY score DESC, userid DESC OFFSET $2 ROWS FETCH NEXT $3 ROWS ONLY",
-                        self.guild.id,
-                        # Offset skips users already present in current_users
-                        self.current_offset + self.lookahead_length,
-                        15 - len(self.current_users) + 15,
-                    )
-
-                raw_bundled = [
-                    ScoreInfo(self.guild.get_member(row["userid"]),
-                              row["score"]) for row in unbundled_complement
-                ]
-
-                # Complete the current 15 user set & record the db offset
-                current_complement, total_complement = calculate_offset(
-                    raw_bundled, 15 - len(self.current_users))
-                self.current_users.extend(current_complement)
-                self.offsets.append(self.current_offset +
-                                    self.lookahead_length + total_complement)
-
-                raw_next_bundles = raw_bundled[total_complement:]
-
-            else:
-                # this has to be done before fetching the next users since otherwise self.next_offset
-                # results in indexing out of bounds (I think)
-                self.offsets.append(self.current_offset +
-                                    self.lookahead_length)
-
-                async with self.db_pool.acquire() as con:
-                    unbundled_next = await con.fetch(
-                        "SELECT userid, score FROM scores WHERE guild = $1 "
-                        "ORDER BY score DESC, userid DESC OFFSET $2 ROWS FETCH NEXT 15 ROWS ONLY",
-                        self.guild.id,
-                        self.next_offset,
-                    )
-
-                raw_next_bundles = [
-                    ScoreInfo(self.guild.get_member(row["userid"]),
-                              row["score"]) for row in unbundled_next
-                ]
-
-            # Fetch (some of) the users to be displayed on the next page
-            valid_next, lookahead = calculate_offset(raw_next_bundles, 15)
-            self.next_users = valid_next
-            self.lookahead_length = lookahead
-
-            # Append a sentinel if the end of the leaderboard was reached
-            if len(self.next_users) == 0:
-                self.offsets.append(-1)
-
-        await self.update(interaction)
+        embed, view = leaderboard_page(guild, ranking, self.owner_id, page)
+        await interaction.response.edit_message(embed=embed, view=view)
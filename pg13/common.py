@@ -4,3 +4,9 @@ class CogMissing(Exception):
         super().__init__(
             f"Cog {attempted} depends on missing cog {missing} which was not loaded."
         )
+
+
+class InvalidConfig(Exception):
+
+    def __init__(self, guild_id, problem):
+        super().__init__(f"Invalid config for guild {guild_id}: {problem}")
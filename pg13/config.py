@@ -1,20 +1,96 @@
+import bisect
+import dataclasses
+import datetime
 import os
+import types
 from pathlib import Path
 
 import toml
 
-thresholds = {}
-bonus_roles = {}
-admins = {}
-door_members = {}
-daily_points = {}
-daily_max = {}
-picture_channels = {}
-lottery_channels = {}
+from .common import InvalidConfig
+
+# guild id -> GuildConfig
+guilds = {}
+write_behind = {}
+claim_batching = {}
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class GuildConfig:
+    """A guild's settings, checked & converted once when the config is loaded.
+
+    Game night thresholds are kept as parallel tuples sorted by minutes so
+    the points for a duration can be found with a binary search.
+    """
+
+    threshold_minutes: tuple
+    threshold_points: tuple
+    bonus_role: int | None
+    admin_users: frozenset
+    admin_roles: frozenset
+    daily_points: int
+    daily_max: int
+    daily_reset: datetime.time
+    door_member: int | None
+    picture_channels: types.MappingProxyType
+    lottery_channel: int | None
+
+    def gamenight_points(self, minutes):
+        """Returns the points for the highest threshold reached, or None."""
+        index = bisect.bisect_right(self.threshold_minutes, minutes)
+        return self.threshold_points[index - 1] if index else None
+
+
+def parse_time(value):
+    # TOML local times are already parsed, but "HH:MM" strings are accepted too
+    if isinstance(value, str):
+        return datetime.time.fromisoformat(value)
+
+    return value
+
+
+def load_guild_config(guild_id, config):
+    try:
+        # TOML makes the threshold keys strings
+        thresholds = sorted(
+            (int(minutes), points)
+            for minutes, points in config["thresholds"].items())
+        admins = config["admins"]
+        daily_reset = parse_time(config.get("daily_reset", "23:58"))
+    except KeyError as e:
+        raise InvalidConfig(guild_id, f"missing {e.args[0]}") from e
+    except ValueError as e:
+        raise InvalidConfig(guild_id, e) from e
+
+    if any(minutes < 0 or not isinstance(points, int)
+           for minutes, points in thresholds):
+        raise InvalidConfig(
+            guild_id, "thresholds must map non-negative minutes to points")
+
+    guild_config = GuildConfig(
+        threshold_minutes=tuple(minutes for minutes, _ in thresholds),
+        threshold_points=tuple(points for _, points in thresholds),
+        bonus_role=config.get("bonus_role"),
+        admin_users=frozenset(admins.get("users", [])),
+        admin_roles=frozenset(admins.get("roles", [])),
+        daily_points=config.get("daily_points", 3),
+        daily_max=config.get("daily_max", 10),
+        daily_reset=daily_reset,
+        door_member=config.get("door_member"),
+        picture_channels=types.MappingProxyType(
+            dict(config.get("picture_channels", {}))),
+        lottery_channel=config.get("lottery_channel"),
+    )
+
+    if guild_config.daily_max < guild_config.daily_points:
+        raise InvalidConfig(guild_id,
+                            "daily_max can't be less than daily_points")
+
+    return guild_config
 
 
 def load_config():
-    global prefix, token
+    global prefix, token, bonus_role_interval, lottery_seed
 
     config_path = Path(os.environ["CREDENTIALS_DIRECTORY"]) / "config.toml"
     config = toml.load(config_path)
@@ -23,22 +99,22 @@ def load_config():
     prefix = config["prefix"]
     token = config["token"]
 
-    # guild-specific stuff
-    for guild_id, config in config["guilds"].items():
-        guild_id = int(guild_id)
+    # Minimum number of seconds between bonus role updates in a guild
+    bonus_role_interval = config.get("bonus_role_interval", 10)
+
+    # Seeds lottery draws so they can be reproduced, e.g. when testing
+    lottery_seed = config.get("lottery_seed")
 
-        thresholds[guild_id] = config["thresholds"]
-        bonus_roles[guild_id] = config.get("bonus_role")
-        admins[guild_id] = config["admins"]
-        daily_points[guild_id] = config.get("daily_points", 3)
-        daily_max[guild_id] = config.get("daily_max", 10)
-        door_members[guild_id] = config.get("door_member")
+    # Optional write-behind buffering of score increments
+    write_behind.update(config.get("write_behind", {}))
 
-        if "picture_channels" in config:
-            picture_channels[guild_id] = config["picture_channels"]
+    # Optional micro-batching of channel bonus claims
+    claim_batching.update(config.get("claim_batching", {}))
 
-        if "lottery_channel" in config:
-            lottery_channels[guild_id] = config["lottery_channel"]
+    # guild-specific stuff
+    for guild_id, guild_config in config["guilds"].items():
+        guild_id = int(guild_id)
+        guilds[guild_id] = load_guild_config(guild_id, guild_config)
 
 
 load_config()
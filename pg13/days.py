@@ -0,0 +1,21 @@
+import datetime
+from zoneinfo import ZoneInfo
+
+# Daily resets happen at local times in this timezone
+RESET_TIMEZONE = ZoneInfo("America/Los_Angeles")
+
+
+def current_day(reset_time, now=None):
+    """Returns the date the current daily period started on.
+
+    Periods run from one reset at `reset_time` to the next, so anything
+    stamped with this date belongs to "today" until the next reset, when it
+    goes stale without having to be cleared.
+    """
+    if now is None:
+        now = datetime.datetime.now(RESET_TIMEZONE)
+
+    since_reset = datetime.timedelta(hours=reset_time.hour,
+                                     minutes=reset_time.minute,
+                                     seconds=reset_time.second)
+    return (now - since_reset).date()
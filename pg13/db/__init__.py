@@ -0,0 +1,2 @@
+from .migrations import run_migrations
+from .scores import ScoresRepository
@@ -0,0 +1,361 @@
+import collections
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Arbitrary key for the advisory lock held while migrating
+MIGRATION_LOCK = 0x70673133
+
+Migration = collections.namedtuple(
+    "Migration", ["version", "description", "statements", "transactional"])
+
+# Migrations are applied in order and never edited once released; schema
+# changes go in a new migration at the end of the list.
+#
+# Non-transactional migrations exist for statements like
+# CREATE INDEX CONCURRENTLY that can't run inside a transaction (but don't
+# block writes on a large live database); they have to be safe to re-run in
+# case the bot dies partway through.
+MIGRATIONS = [
+    Migration(
+        1,
+        "Baseline tables",
+        [
+            "CREATE TABLE IF NOT EXISTS scores"
+            "(guild BIGINT, userid BIGINT, score INT, UNIQUE(guild, userid))",
+
+            # Every score change ever made; `scores` holds the running balances
+            "CREATE TABLE IF NOT EXISTS score_ledger"
+            "(guild BIGINT, userid BIGINT, points INT, multiplier INT, reason TEXT, "
+            "source TEXT, created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP) "
+            "PARTITION BY RANGE (created_at)",
+
+            # Broadcast every score change so other bot processes can keep
+            # their rankings in sync
+            """
+            CREATE OR REPLACE FUNCTION notify_score_change() RETURNS trigger AS $$
+            BEGIN
+                PERFORM pg_notify('score_changes', NEW.guild || ' ' || NEW.userid || ' ' || NEW.score);
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+            "CREATE OR REPLACE TRIGGER score_changes AFTER INSERT OR UPDATE ON scores "
+            "FOR EACH ROW EXECUTE FUNCTION notify_score_change()",
+            "CREATE TABLE IF NOT EXISTS guild_members"
+            "(guild BIGINT, userid BIGINT, PRIMARY KEY(guild, userid))",
+
+            # Channel bonuses
+            "CREATE TABLE IF NOT EXISTS channel_bonuses"
+            "(channel BIGINT, guild BIGINT, points INT, attachment BOOLEAN, UNIQUE(channel, guild))",
+
+            # Channel bonus claims
+            "CREATE TABLE IF NOT EXISTS channel_claims"
+            "(channel BIGINT, guild BIGINT, userid BIGINT, UNIQUE(channel, userid))",
+
+            # `/daily claim` uses
+            "CREATE TABLE IF NOT EXISTS daily_claims"
+            "(guild BIGINT, userid BIGINT, claimed BOOLEAN, streak_bonus INT, UNIQUE(guild, userid))",
+
+            # Ongoing gamenights
+            "CREATE TABLE IF NOT EXISTS gamenights"
+            "(voice_channel BIGINT UNIQUE, guild BIGINT, host BIGINT, "
+            "start_channel BIGINT, UNIQUE(guild, host))",
+
+            # Voice channel duration tracking
+            "CREATE TABLE IF NOT EXISTS voice_logs"
+            "(channel BIGINT, guild BIGINT, userid BIGINT, "
+            "duration INTERVAL, join_time TIMESTAMP WITH TIME ZONE, "
+            "UNIQUE(channel, userid))",
+            "CREATE TABLE IF NOT EXISTS lottery"
+            "(guild BIGINT, userid BIGINT, PRIMARY KEY(guild, userid))",
+        ],
+        True,
+    ),
+    Migration(
+        2,
+        "Indexes for leaderboard, claim & voice log queries",
+        [
+            # Invalid leftovers from an interrupted CREATE INDEX CONCURRENTLY
+            # would otherwise be skipped by IF NOT EXISTS
+            """
+            DO $$
+            DECLARE leftover TEXT;
+            BEGIN
+                FOR leftover IN SELECT indexrelid::regclass::TEXT FROM pg_index
+                    WHERE NOT indisvalid AND indexrelid::regclass::TEXT IN
+                        ('scores_ranking_idx', 'channel_claims_user_idx',
+                         'voice_logs_channel_idx', 'channel_bonuses_guild_idx')
+                LOOP
+                    EXECUTE 'DROP INDEX ' || leftover;
+                END LOOP;
+            END;
+            $$
+            """,
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS scores_ranking_idx "
+            "ON scores (guild, score DESC, userid DESC)",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS channel_claims_user_idx "
+            "ON channel_claims (guild, userid)",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS voice_logs_channel_idx "
+            "ON voice_logs (channel)",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS channel_bonuses_guild_idx "
+            "ON channel_bonuses (guild)",
+        ],
+        False,
+    ),
+    Migration(
+        3,
+        "Per-guild score totals",
+        [
+            # Nothing can write scores while the totals are seeded below
+            "LOCK TABLE scores IN SHARE MODE",
+            "CREATE TABLE IF NOT EXISTS guild_totals"
+            "(guild BIGINT PRIMARY KEY, total BIGINT)",
+
+            # Statement-level triggers so a batched upsert touches each
+            # guild's total once instead of once per row
+            """
+            CREATE OR REPLACE FUNCTION update_guild_totals() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    INSERT INTO guild_totals
+                        SELECT guild, sum(score) FROM new_rows GROUP BY guild
+                        ON CONFLICT(guild) DO UPDATE SET total = guild_totals.total + EXCLUDED.total;
+                ELSIF TG_OP = 'UPDATE' THEN
+                    INSERT INTO guild_totals
+                        SELECT new_rows.guild, sum(new_rows.score - old_rows.score)
+                        FROM new_rows JOIN old_rows USING (guild, userid) GROUP BY new_rows.guild
+                        ON CONFLICT(guild) DO UPDATE SET total = guild_totals.total + EXCLUDED.total;
+                ELSE
+                    UPDATE guild_totals SET total = total - removed.total
+                        FROM (SELECT guild, sum(score) AS total FROM old_rows GROUP BY guild) AS removed
+                        WHERE guild_totals.guild = removed.guild;
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+            "CREATE OR REPLACE TRIGGER guild_totals_insert AFTER INSERT ON scores "
+            "REFERENCING NEW TABLE AS new_rows "
+            "FOR EACH STATEMENT EXECUTE FUNCTION update_guild_totals()",
+            "CREATE OR REPLACE TRIGGER guild_totals_update AFTER UPDATE ON scores "
+            "REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows "
+            "FOR EACH STATEMENT EXECUTE FUNCTION update_guild_totals()",
+            "CREATE OR REPLACE TRIGGER guild_totals_delete AFTER DELETE ON scores "
+            "REFERENCING OLD TABLE AS old_rows "
+            "FOR EACH STATEMENT EXECUTE FUNCTION update_guild_totals()",
+            "INSERT INTO guild_totals SELECT guild, sum(score) FROM scores GROUP BY guild "
+            "ON CONFLICT(guild) DO UPDATE SET total = EXCLUDED.total",
+        ],
+        True,
+    ),
+    Migration(
+        4,
+        "Server-side channel bonus claims",
+        [
+            # Claims a channel bonus and awards its points (plus one if every
+            # bonus in the guild is now claimed) in a single round trip.
+            # Returns no rows if the bonus was already claimed.
+            """
+            CREATE OR REPLACE FUNCTION claim_channel_bonus(
+                claim_channel BIGINT, claim_guild BIGINT, claim_userid BIGINT,
+                claim_points INT, claim_multiplier INT, claim_reason TEXT,
+                claim_source TEXT)
+            RETURNS TABLE(awarded INT, new_score INT) AS $$
+            DECLARE
+                claimed_count BIGINT;
+                bonus_count BIGINT;
+            BEGIN
+                INSERT INTO channel_claims VALUES(claim_channel, claim_guild, claim_userid)
+                    ON CONFLICT(channel, userid) DO NOTHING;
+                IF NOT FOUND THEN
+                    RETURN;
+                END IF;
+
+                SELECT count(*) INTO claimed_count FROM channel_claims
+                    WHERE guild = claim_guild AND userid = claim_userid;
+                SELECT count(*) INTO bonus_count FROM channel_bonuses
+                    WHERE guild = claim_guild;
+                awarded := (claim_points + (claimed_count = bonus_count)::INT) * claim_multiplier;
+
+                INSERT INTO score_ledger (guild, userid, points, multiplier, reason, source)
+                    VALUES(claim_guild, claim_userid, awarded, claim_multiplier,
+                           claim_reason, claim_source);
+                INSERT INTO scores VALUES(claim_guild, claim_userid, awarded)
+                    ON CONFLICT(guild, userid) DO UPDATE SET score = scores.score + EXCLUDED.score
+                    RETURNING scores.score INTO new_score;
+
+                RETURN NEXT;
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+        ],
+        True,
+    ),
+    Migration(
+        5,
+        "Date-stamped daily claims & voice logs",
+        [
+            # Rows are stamped with the day they belong to instead of being
+            # cleared at every reset. Existing rows are stamped with the
+            # current day under the default reset times (23:58 for claims,
+            # 11:59 for voice logs).
+            "ALTER TABLE channel_claims ADD COLUMN IF NOT EXISTS claim_day DATE",
+            "UPDATE channel_claims SET claim_day = "
+            "(CURRENT_TIMESTAMP AT TIME ZONE 'America/Los_Angeles' - INTERVAL '23:58')::DATE",
+
+            # Streaks continue if the last claim was the day before; the
+            # stamps below reproduce what the next nightly reset would've done
+            "ALTER TABLE daily_claims ADD COLUMN IF NOT EXISTS claim_day DATE",
+            "UPDATE daily_claims SET claim_day = "
+            "(CURRENT_TIMESTAMP AT TIME ZONE 'America/Los_Angeles' - INTERVAL '23:58')::DATE - "
+            "CASE WHEN claimed THEN 0 WHEN streak_bonus >= 0 THEN 1 ELSE 2 END",
+            "ALTER TABLE daily_claims DROP COLUMN claimed",
+            "ALTER TABLE voice_logs ADD COLUMN IF NOT EXISTS log_day DATE",
+            "UPDATE voice_logs SET log_day = "
+            "(CURRENT_TIMESTAMP AT TIME ZONE 'America/Los_Angeles' - INTERVAL '11:59')::DATE",
+            "ALTER TABLE gamenights ADD COLUMN IF NOT EXISTS started_on DATE",
+            "UPDATE gamenights SET started_on = "
+            "(CURRENT_TIMESTAMP AT TIME ZONE 'America/Los_Angeles' - INTERVAL '11:59')::DATE",
+            "DROP FUNCTION claim_channel_bonus(BIGINT, BIGINT, BIGINT, INT, INT, TEXT, TEXT)",
+            """
+            CREATE OR REPLACE FUNCTION claim_channel_bonus(
+                claim_channel BIGINT, claim_guild BIGINT, claim_userid BIGINT,
+                claim_on DATE, claim_points INT, claim_multiplier INT,
+                claim_reason TEXT, claim_source TEXT)
+            RETURNS TABLE(awarded INT, new_score INT) AS $$
+            DECLARE
+                claimed_count BIGINT;
+                bonus_count BIGINT;
+            BEGIN
+                -- A claim from an earlier day is as good as no claim
+                INSERT INTO channel_claims VALUES(claim_channel, claim_guild, claim_userid, claim_on)
+                    ON CONFLICT(channel, userid) DO UPDATE SET claim_day = EXCLUDED.claim_day
+                    WHERE channel_claims.claim_day < EXCLUDED.claim_day;
+                IF NOT FOUND THEN
+                    RETURN;
+                END IF;
+
+                SELECT count(*) INTO claimed_count FROM channel_claims
+                    WHERE guild = claim_guild AND userid = claim_userid AND claim_day = claim_on;
+                SELECT count(*) INTO bonus_count FROM channel_bonuses
+                    WHERE guild = claim_guild;
+                awarded := (claim_points + (claimed_count = bonus_count)::INT) * claim_multiplier;
+
+                INSERT INTO score_ledger (guild, userid, points, multiplier, reason, source)
+                    VALUES(claim_guild, claim_userid, awarded, claim_multiplier,
+                           claim_reason, claim_source);
+                INSERT INTO scores VALUES(claim_guild, claim_userid, awarded)
+                    ON CONFLICT(guild, userid) DO UPDATE SET score = scores.score + EXCLUDED.score
+                    RETURNING scores.score INTO new_score;
+
+                RETURN NEXT;
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+        ],
+        True,
+    ),
+    Migration(
+        6,
+        "Weighted lottery tickets",
+        [
+            # Each purchase is a block of tickets numbered from first_ticket
+            # within its guild, so a winning ticket number can be found with
+            # an index seek instead of sorting every ticket
+            "ALTER TABLE lottery DROP CONSTRAINT lottery_pkey",
+            "ALTER TABLE lottery ADD COLUMN first_ticket INT, "
+            "ADD COLUMN tickets INT NOT NULL DEFAULT 1",
+            "UPDATE lottery SET first_ticket = numbered.first_ticket FROM "
+            "(SELECT guild, userid, row_number() OVER (PARTITION BY guild ORDER BY userid) - 1 "
+            "AS first_ticket FROM lottery) AS numbered "
+            "WHERE lottery.guild = numbered.guild AND lottery.userid = numbered.userid",
+            "ALTER TABLE lottery ADD PRIMARY KEY (guild, first_ticket)",
+            "CREATE INDEX lottery_user_idx ON lottery (guild, userid)",
+
+            # Number of tickets sold in each guild; its row lock also
+            # serializes ticket numbering
+            "CREATE TABLE IF NOT EXISTS lottery_pools"
+            "(guild BIGINT PRIMARY KEY, tickets INT)",
+            "INSERT INTO lottery_pools SELECT guild, count(*) FROM lottery GROUP BY guild",
+        ],
+        True,
+    ),
+    Migration(
+        7,
+        "Lottery draw ledger",
+        [
+            # One row per guild & weekly drawing (dated by the Sunday it's
+            # on), inserted before the draw so it can't happen twice
+            "CREATE TABLE IF NOT EXISTS lottery_draws"
+            "(guild BIGINT, draw_week DATE, winner BIGINT, prize INT, "
+            "drawn_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP, "
+            "PRIMARY KEY(guild, draw_week))",
+
+            # Tickets are for a specific drawing; existing ones are for the
+            # next one
+            "ALTER TABLE lottery ADD COLUMN IF NOT EXISTS draw_week DATE",
+            "ALTER TABLE lottery_pools ADD COLUMN IF NOT EXISTS draw_week DATE",
+            "UPDATE lottery SET draw_week = day + (7 - EXTRACT(ISODOW FROM day)::INT % 7) FROM "
+            "(SELECT (CURRENT_TIMESTAMP AT TIME ZONE 'America/Los_Angeles' - INTERVAL '12 hours')::DATE "
+            "AS day) AS today",
+            "UPDATE lottery_pools SET draw_week = day + (7 - EXTRACT(ISODOW FROM day)::INT % 7) FROM "
+            "(SELECT (CURRENT_TIMESTAMP AT TIME ZONE 'America/Los_Angeles' - INTERVAL '12 hours')::DATE "
+            "AS day) AS today",
+            "ALTER TABLE lottery DROP CONSTRAINT lottery_pkey, "
+            "ADD PRIMARY KEY (guild, draw_week, first_ticket)",
+            "ALTER TABLE lottery_pools DROP CONSTRAINT lottery_pools_pkey, "
+            "ADD PRIMARY KEY (guild, draw_week)",
+            "DROP INDEX lottery_user_idx",
+            "CREATE INDEX lottery_user_idx ON lottery (guild, draw_week, userid)",
+        ],
+        True,
+    ),
+]
+
+
+async def apply_migration(con, migration):
+    for statement in migration.statements:
+        await con.execute(statement)
+
+    await con.execute(
+        "INSERT INTO schema_migrations (version, description) VALUES($1, $2)",
+        migration.version,
+        migration.description,
+    )
+
+
+async def run_migrations(db_pool):
+    """Brings the database schema up to date.
+
+    This is run once at startup, before any cogs are loaded.
+    """
+    async with db_pool.acquire() as con:
+        # Only one bot process should migrate at a time
+        await con.execute("SELECT pg_advisory_lock($1)", MIGRATION_LOCK)
+
+        try:
+            await con.execute(
+                "CREATE TABLE IF NOT EXISTS schema_migrations"
+                "(version INT PRIMARY KEY, description TEXT, "
+                "applied_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP)"
+            )
+            current_version = await con.fetchval(
+                "SELECT COALESCE(max(version), 0) FROM schema_migrations")
+
+            for migration in MIGRATIONS:
+                if migration.version <= current_version:
+                    continue
+
+                logger.info(
+                    f"Applying migration {migration.version}: {migration.description}"
+                )
+
+                if migration.transactional:
+                    async with con.transaction():
+                        await apply_migration(con, migration)
+                else:
+                    await apply_migration(con, migration)
+
+        finally:
+            await con.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK)
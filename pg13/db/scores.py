@@ -0,0 +1,306 @@
+import contextlib
+import datetime
+import logging
+
+logger = logging.getLogger(__name__)
+
+# asyncpg prepares every statement it runs and caches the prepared statement
+# on the connection it ran on, keyed by the query text. Keeping the queries as
+# constants means each pooled connection only prepares each of them once.
+GET_SCORE = "SELECT score FROM scores WHERE guild = $1 AND userid = $2"
+
+GET_SCORES = (
+    "SELECT userid, score FROM scores "
+    "WHERE guild = $1 AND userid = ANY($2::BIGINT[])")
+
+ALL_SCORES = "SELECT guild, userid, score FROM scores ORDER BY guild, score, userid"
+
+GUILD_SCORES = "SELECT userid, score FROM scores WHERE guild = $1 ORDER BY score, userid"
+
+# guild_totals is kept up to date by triggers on scores
+GUILD_TOTAL = "SELECT total FROM guild_totals WHERE guild = $1"
+
+REBUILD_TOTALS = (
+    "INSERT INTO guild_totals SELECT guild, sum(score) FROM scores GROUP BY guild "
+    "ON CONFLICT(guild) DO UPDATE SET total = EXCLUDED.total")
+
+# Joining against guild_members skips users who left the server
+TOP_SCORES = (
+    "SELECT userid, score FROM scores JOIN guild_members USING (guild, userid) "
+    "WHERE guild = $1 ORDER BY score DESC, userid DESC LIMIT $2")
+
+TOP_SCORES_MANY = (
+    "SELECT guild, userid, score FROM ("
+    "SELECT guild, userid, score, row_number() OVER "
+    "(PARTITION BY guild ORDER BY score DESC, userid DESC) AS place "
+    "FROM scores JOIN guild_members USING (guild, userid) "
+    "WHERE guild = ANY($1::BIGINT[])) AS ranked "
+    "WHERE place <= $2 ORDER BY guild, place")
+
+INSERT_LEDGER = (
+    "INSERT INTO score_ledger (guild, userid, points, multiplier, reason, source, created_at) "
+    "SELECT * FROM unnest($1::BIGINT[], $2::BIGINT[], $3::INT[], $4::INT[], $5::TEXT[], $6::TEXT[], $7::TIMESTAMPTZ[])"
+)
+
+INCREMENT_SCORES = (
+    "INSERT INTO scores (guild, userid, score) "
+    "SELECT * FROM unnest($1::BIGINT[], $2::BIGINT[], $3::INT[]) "
+    "ON CONFLICT(guild, userid) DO UPDATE SET score = scores.score + EXCLUDED.score "
+    "RETURNING guild, userid, score")
+
+SET_SCORE = (
+    "WITH old_score AS (SELECT score FROM scores WHERE guild = $1 AND userid = $2), "
+    "ledger AS (INSERT INTO score_ledger (guild, userid, points, multiplier, reason, source) "
+    "SELECT $1, $2, $3 - COALESCE((SELECT score FROM old_score), 0), 1, $4, $5) "
+    "INSERT INTO scores VALUES($1, $2, $3) "
+    "ON CONFLICT(guild, userid) DO UPDATE SET score = EXCLUDED.score")
+
+SPEND_POINTS = (
+    "WITH spent AS (UPDATE scores SET score = score - $3 "
+    "WHERE guild = $1 AND userid = $2 AND score >= $3 RETURNING guild, userid, score), "
+    "ledger AS (INSERT INTO score_ledger (guild, userid, points, multiplier, reason, source) "
+    "SELECT guild, userid, -$3, 1, $4, $5 FROM spent) "
+    "SELECT score FROM spent")
+
+IMPORT_SCORES = "INSERT INTO scores VALUES($1, $2, $3)"
+
+CLAIM_CHANNEL_BONUS = "SELECT * FROM claim_channel_bonus($1, $2, $3, $4, $5, $6, $7, $8)"
+
+# Set-based version of claim_channel_bonus() for a batch of claims. Each
+# user's claim that completes their set in a guild gets the extra point; the
+# subqueries see channel_claims as it was before this statement.
+CLAIM_CHANNEL_BONUSES = (
+    "WITH requested AS (SELECT DISTINCT ON (channel, userid) * FROM "
+    "unnest($1::BIGINT[], $2::BIGINT[], $3::BIGINT[], $4::DATE[], $5::INT[], $6::TEXT[]) "
+    "AS r(channel, guild, userid, claim_day, points, reason)), "
+    "claimed AS (INSERT INTO channel_claims "
+    "SELECT channel, guild, userid, claim_day FROM requested "
+    "ON CONFLICT(channel, userid) DO UPDATE SET claim_day = EXCLUDED.claim_day "
+    "WHERE channel_claims.claim_day < EXCLUDED.claim_day RETURNING channel, userid), "
+    "awards AS (SELECT r.guild, r.userid, r.reason, (r.points + "
+    "(row_number() OVER user_claims = 1 AND count(*) OVER user_claims + "
+    "(SELECT count(*) FROM channel_claims AS c WHERE c.guild = r.guild "
+    "AND c.userid = r.userid AND c.claim_day = r.claim_day) = "
+    "(SELECT count(*) FROM channel_bonuses AS b WHERE b.guild = r.guild))::INT) * $7 AS points "
+    "FROM requested AS r JOIN claimed USING (channel, userid) "
+    "WINDOW user_claims AS (PARTITION BY r.guild, r.userid)), "
+    "ledger AS (INSERT INTO score_ledger (guild, userid, points, multiplier, reason, source) "
+    "SELECT guild, userid, points, $7, reason, $8 FROM awards) "
+    "INSERT INTO scores (guild, userid, score) "
+    "SELECT guild, userid, sum(points) FROM awards GROUP BY guild, userid "
+    "ON CONFLICT(guild, userid) DO UPDATE SET score = scores.score + EXCLUDED.score "
+    "RETURNING guild, userid, score")
+
+LEDGER_PARTITIONS = (
+    "SELECT inhrelid::regclass::TEXT AS name FROM pg_inherits "
+    "WHERE inhparent = 'score_ledger'::regclass ORDER BY name")
+
+
+def add_month(date):
+    """Returns the first day of the month after `date`."""
+    return (date.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+
+
+def ledger_partition(month_start):
+    return f"score_ledger_y{month_start:%Y}m{month_start:%m}"
+
+
+class ScoresRepository:
+    """Owns every query against the scores & score ledger tables.
+
+    Each method takes an optional connection so it can take part in a
+    transaction the caller already started; otherwise one is acquired from the
+    pool for just that call.
+    """
+
+    def __init__(self, db_pool):
+        self.db_pool = db_pool
+
+    @contextlib.asynccontextmanager
+    async def connection(self, con=None):
+        if con is not None:
+            yield con
+        else:
+            async with self.db_pool.acquire() as con:
+                yield con
+
+    async def get_score(self, guild_id, userid, con=None):
+        """Gets a user's score in the provided guild.
+
+        Returns None if they have no points yet.
+        """
+        async with self.connection(con) as con:
+            return await con.fetchval(GET_SCORE, guild_id, userid)
+
+    async def get_scores(self, guild_id, userids, con=None):
+        """Gets the scores of several users in a guild as a userid -> score dict.
+
+        Users without any points are left out.
+        """
+        async with self.connection(con) as con:
+            rows = await con.fetch(GET_SCORES, guild_id, list(userids))
+
+        return {row["userid"]: row["score"] for row in rows}
+
+    async def all_scores(self, con=None):
+        """Fetches every score, sorted ascending by guild, score & userid."""
+        async with self.connection(con) as con:
+            return await con.fetch(ALL_SCORES)
+
+    async def guild_scores(self, guild_id, con=None):
+        """Fetches every score in a guild, sorted ascending by score & userid."""
+        async with self.connection(con) as con:
+            return await con.fetch(GUILD_SCORES, guild_id)
+
+    async def guild_total(self, guild_id, con=None):
+        async with self.connection(con) as con:
+            return await con.fetchval(GUILD_TOTAL, guild_id)
+
+    async def rebuild_totals(self, con=None):
+        """Recomputes every guild's total from scratch."""
+        async with self.connection(con) as con, con.transaction():
+            # Keep scores from changing until the totals are consistent again
+            await con.execute("LOCK TABLE scores IN SHARE MODE")
+            await con.execute("DELETE FROM guild_totals")
+            await con.execute(REBUILD_TOTALS)
+
+    async def top_scores(self, guild_id, count, con=None):
+        """Fetches the (userid, score) rows of a guild's top current members."""
+        async with self.connection(con) as con:
+            return await con.fetch(TOP_SCORES, guild_id, count)
+
+    async def top_scores_many(self, guild_ids, count, con=None):
+        """Fetches the top current members of several guilds in one query.
+
+        Returns a guild id -> list of (userid, score) rows dict.
+        """
+        async with self.connection(con) as con:
+            rows = await con.fetch(TOP_SCORES_MANY, list(guild_ids), count)
+
+        top = {guild_id: [] for guild_id in guild_ids}
+        for row in rows:
+            top[row["guild"]].append(row)
+
+        return top
+
+    async def increment_many(self, increments, ledger_entries, con=None):
+        """Records ledger entries and applies their coalesced increments to
+        the score balances in one transaction.
+
+        `increments` should map (guild, userid) tuples to point totals, and
+        `ledger_entries` be a list of (guild, userid, points, multiplier,
+        reason, source, created_at) tuples. Returns the updated (guild,
+        userid, score) rows.
+        """
+        if not increments:
+            return []
+
+        guild_ids, user_ids = zip(*increments.keys())
+
+        async with self.connection(con) as con, con.transaction():
+            await con.execute(INSERT_LEDGER,
+                              *map(list, zip(*ledger_entries)))
+            return await con.fetch(INCREMENT_SCORES, list(guild_ids),
+                                   list(user_ids), list(increments.values()))
+
+    async def set_score(self,
+                        guild_id,
+                        userid,
+                        score,
+                        reason=None,
+                        source=None,
+                        con=None):
+        """Sets a user's score, recording the difference in the ledger."""
+        async with self.connection(con) as con:
+            await con.execute(SET_SCORE, guild_id, userid, score, reason,
+                              source)
+
+    async def spend_points(self,
+                           guild_id,
+                           userid,
+                           points,
+                           reason=None,
+                           source=None,
+                           con=None):
+        """Takes points from a user if they have enough of them.
+
+        Returns their new score, or None if they couldn't afford it.
+        """
+        async with self.connection(con) as con:
+            return await con.fetchval(SPEND_POINTS, guild_id, userid, points,
+                                      reason, source)
+
+    async def claim_channel_bonus(self,
+                                  channel_id,
+                                  guild_id,
+                                  userid,
+                                  claim_day,
+                                  points,
+                                  multiplier,
+                                  reason=None,
+                                  source=None,
+                                  con=None):
+        """Claims a channel bonus & awards its points in one round trip.
+
+        Returns an (awarded, new_score) row, or None if it was already claimed
+        on `claim_day`.
+        """
+        async with self.connection(con) as con:
+            return await con.fetchrow(CLAIM_CHANNEL_BONUS, channel_id,
+                                      guild_id, userid, claim_day, points,
+                                      multiplier, reason, source)
+
+    async def claim_channel_bonuses(self,
+                                    claims,
+                                    multiplier,
+                                    source=None,
+                                    con=None):
+        """Claims a batch of channel bonuses in a single statement.
+
+        `claims` should be a list of (channel, guild, userid, claim_day,
+        points, reason) tuples. Returns the updated (guild, userid, score) rows of the users
+        whose claims went through.
+        """
+        if not claims:
+            return []
+
+        async with self.connection(con) as con:
+            return await con.fetch(CLAIM_CHANNEL_BONUSES,
+                                   *map(list, zip(*claims)), multiplier,
+                                   source)
+
+    async def import_scores(self, rows, con=None):
+        """Inserts (guild, userid, score) rows as-is, e.g. when migrating."""
+        async with self.connection(con) as con:
+            await con.executemany(IMPORT_SCORES, rows)
+
+    async def create_ledger_partitions(self, month_starts, con=None):
+        """Creates the monthly ledger partitions starting at `month_starts`."""
+        async with self.connection(con) as con:
+            for month_start in month_starts:
+                await con.execute(
+                    f"CREATE TABLE IF NOT EXISTS {ledger_partition(month_start)} "
+                    f"PARTITION OF score_ledger FOR VALUES FROM ('{month_start}') "
+                    f"TO ('{add_month(month_start)}')")
+
+    async def detach_ledger_partitions(self, before, con=None):
+        """Detaches ledger partitions for months before `before`.
+
+        The detached tables are left in place so they can still be queried,
+        archived or dropped separately. Returns their names.
+        """
+        async with self.connection(con) as con:
+            partitions = await con.fetch(LEDGER_PARTITIONS)
+
+            cutoff = ledger_partition(before.replace(day=1))
+            detached = [
+                row["name"] for row in partitions if row["name"] < cutoff
+            ]
+
+            # CONCURRENTLY avoids blocking score writes while detaching
+            for name in detached:
+                await con.execute(
+                    f"ALTER TABLE score_ledger DETACH PARTITION {name} CONCURRENTLY"
+                )
+
+        return detached
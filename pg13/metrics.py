@@ -0,0 +1,36 @@
+import collections
+
+# Simple in-process metrics, shown by the owner-only `metrics` command
+counters = collections.Counter()
+summaries = {}
+
+
+class Summary:
+    """Tracks the count, total & maximum of some observed value."""
+
+    __slots__ = ("count", "total", "maximum")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.maximum = 0
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        self.maximum = max(self.maximum, value)
+
+    def __str__(self):
+        mean = self.total / self.count if self.count else 0
+        return f"count {self.count}, mean {mean:.2f}, max {self.maximum:.2f}"
+
+
+def increment(name, amount=1):
+    counters[name] += amount
+
+
+def observe(name, value):
+    if (summary := summaries.get(name)) is None:
+        summary = summaries[name] = Summary()
+
+    summary.observe(value)
@@ -0,0 +1,89 @@
+import collections
+import hashlib
+import io
+import logging
+import time
+import urllib.parse
+
+import discord
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Cached URLs that expire within this many seconds are uploaded again instead
+EXPIRY_MARGIN = 60 * 60
+
+
+def url_expiry(url):
+    """Returns when a signed CDN attachment URL expires (from its hex `ex`
+    parameter) as a Unix timestamp, or None if it isn't signed.
+    """
+    query = urllib.parse.parse_qs(urllib.parse.urlsplit(url).query)
+    if not (expiry := query.get("ex")):
+        return None
+
+    try:
+        return int(expiry[0], 16)
+    except ValueError:
+        return None
+
+
+class UploadCache:
+    """Maps the SHA-256 of uploaded files to the URL of their attachment.
+
+    Sending a file that was uploaded before just embeds the earlier
+    attachment instead of uploading the same bytes again. This only works
+    while the message it was attached to still exists; deleting it breaks
+    every reuse of the attachment's URL.
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.urls = collections.OrderedDict()
+
+    def lookup(self, digest):
+        if (url := self.urls.get(digest)) is None:
+            return None
+
+        expiry = url_expiry(url)
+        if expiry is not None and expiry - time.time() < EXPIRY_MARGIN:
+            del self.urls[digest]
+            return None
+
+        self.urls.move_to_end(digest)
+        return url
+
+    def store(self, digest, url):
+        self.urls[digest] = url
+        self.urls.move_to_end(digest)
+
+        while len(self.urls) > self.max_entries:
+            self.urls.popitem(last=False)
+
+    async def send_file(self, send, data, filename, **kwargs):
+        """Sends `data` as a file with `send` (e.g. `channel.send` or
+        `ctx.reply`), or an embed of an earlier upload of the same content.
+
+        Returns the sent message.
+        """
+        digest = hashlib.sha256(data).hexdigest()
+
+        if (url := self.lookup(digest)) is not None:
+            metrics.increment("uploads.reused")
+            return await send(embed=discord.Embed().set_image(url=url),
+                              **kwargs)
+
+        message = await send(file=discord.File(io.BytesIO(data),
+                                               filename=filename),
+                             **kwargs)
+        metrics.increment("uploads.uploaded")
+
+        if message.attachments:
+            self.store(digest, message.attachments[0].url)
+
+        return message
+
+
+# Shared by every cog that sends files
+upload_cache = UploadCache()